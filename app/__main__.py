@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from app import pdf
+from app.download import sha256_file
+from app.ingest import INGEST_WORKERS, discard_partial, document_metadata
+from app.rag import LLM_QUEUE_SIZE, normalize_tags, rag_engine
+
+QUERY_STAGES = ("retrieval", "prompt", "queue", "generation")
+QUERY_OVERRIDES = ("k", "max_new_tokens", "temperature", "doc_ids", "tags")
+
+_claim_lock = threading.Lock()
+
+
+def find_pdfs(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".pdf"):
+                    yield os.path.join(root, name)
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))], 4)
+
+
+def _rate(count: float, seconds: float) -> float:
+    return round(count / seconds, 3) if seconds > 0 else 0.0
+
+
+def _ingest_file(path: str, filename: str, tags: List[str], run_id: str, claimed: Dict[str, str]) -> Dict:
+    file_sha256 = sha256_file(path)
+    existing = rag_engine.find_document(file_sha256)
+    if existing is not None:
+        return {"status": "already_indexed", "doc_id": existing["doc_id"], "file_sha256": file_sha256}
+    # copies of one file in the tree are indexed once, even when workers
+    # reach them at the same time
+    with _claim_lock:
+        first = claimed.setdefault(file_sha256, filename)
+    if first != filename:
+        return {"status": "duplicate", "duplicate_of": first, "file_sha256": file_sha256}
+
+    counts = {"pages_parsed": 0, "chunks_persisted": 0}
+    lock = threading.Lock()
+
+    def on_progress(stage: str, count: int):
+        if stage in counts:
+            with lock:
+                counts[stage] += count
+
+    doc_id = uuid.uuid4().hex
+    try:
+        chunks = rag_engine.ingest_document(
+            path, on_progress=on_progress, metadata=document_metadata(doc_id, run_id, filename, file_sha256, tags)
+        )
+    except Exception:
+        discard_partial(rag_engine, doc_id, filename)
+        raise
+    if not chunks:
+        raise ValueError("document appears to be empty or unreadable.")
+    return {"status": "completed", "doc_id": doc_id, "file_sha256": file_sha256, **counts}
+
+
+def _index_file(path: str, root: str, tags: List[str], run_id: str, claimed: Dict[str, str]) -> Dict:
+    filename = os.path.relpath(path, root) if root else os.path.basename(path)
+    started = time.perf_counter()
+    try:
+        result = _ingest_file(path, filename, tags, run_id, claimed)
+    except Exception as e:
+        result = {"status": "failed", "error": str(e)}
+    return {"filename": filename, "path": path, **result, "seconds": round(time.perf_counter() - started, 4)}
+
+
+def index_command(args) -> int:
+    started = time.perf_counter()
+    rag_engine.initialize("embeddings", "vector_store")
+    load_seconds = time.perf_counter() - started
+
+    paths = list(find_pdfs(args.paths))
+    root = args.paths[0] if len(args.paths) == 1 and os.path.isdir(args.paths[0]) else ""
+    tags = normalize_tags((args.tags or "").split(","))
+    run_id = uuid.uuid4().hex
+    claimed: Dict[str, str] = {}
+    print(f"indexing {len(paths)} pdf files with {args.workers} workers", file=sys.stderr)
+
+    results = []
+    output = open(args.output, "w") if args.output else None
+    index_started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="index") as executor:
+            for result in executor.map(lambda path: _index_file(path, root, tags, run_id, claimed), paths):
+                results.append(result)
+                print(f"{result['status']}: {result['filename']}", file=sys.stderr)
+                if output:
+                    output.write(json.dumps(result) + "\n")
+    finally:
+        if output:
+            output.close()
+        pdf.shutdown_pool()
+
+    seconds = time.perf_counter() - index_started
+    pages = sum(result.get("pages_parsed", 0) for result in results)
+    chunks = sum(result.get("chunks_persisted", 0) for result in results)
+    statuses = [result["status"] for result in results]
+    summary = {
+        "files": len(results),
+        "completed": statuses.count("completed"),
+        "already_indexed": statuses.count("already_indexed"),
+        "duplicate": statuses.count("duplicate"),
+        "failed": statuses.count("failed"),
+        "pages_parsed": pages,
+        "chunks_persisted": chunks,
+        "load_seconds": round(load_seconds, 3),
+        "index_seconds": round(seconds, 3),
+        "pages_per_second": _rate(pages, seconds),
+        "chunks_per_second": _rate(chunks, seconds),
+    }
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+def read_questions(path: str) -> Iterator[Dict]:
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            item.setdefault("id", number)
+            yield item
+
+
+def _answer(item: Dict, defaults: Dict) -> Dict:
+    question = (item.get("question") or item.get("text") or item.get("query") or "").strip()
+    overrides = {**defaults, **{key: item[key] for key in QUERY_OVERRIDES if item.get(key) is not None}}
+    timings: Dict = {}
+    started = time.perf_counter()
+    result = {"id": item["id"], "question": question}
+    try:
+        if not question:
+            raise ValueError("no question given.")
+        result["answer"] = rag_engine.query(question, timings=timings, raise_errors=True, **overrides)
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    result["cached"] = timings.pop("cached", False)
+    result["timings"] = timings
+    return result
+
+
+def ask_command(args) -> int:
+    started = time.perf_counter()
+    rag_engine.initialize()
+    load_seconds = time.perf_counter() - started
+
+    defaults = {
+        key: value
+        for key, value in (
+            ("k", args.k),
+            ("max_new_tokens", args.max_new_tokens),
+            ("temperature", args.temperature),
+            ("timeout", args.timeout),
+        )
+        if value is not None
+    }
+    results = []
+    ask_started = time.perf_counter()
+    # concurrent questions are what lets the retrieval batcher group them
+    # and keeps every model instance busy
+    with open(args.output, "w") as output, ThreadPoolExecutor(
+        max_workers=max(1, args.concurrency), thread_name_prefix="ask"
+    ) as executor:
+        for result in executor.map(lambda item: _answer(item, defaults), read_questions(args.questions)):
+            results.append(result)
+            output.write(json.dumps(result) + "\n")
+            if len(results) % 100 == 0:
+                print(f"answered {len(results)} questions", file=sys.stderr)
+
+    seconds = time.perf_counter() - ask_started
+    latencies = [result["seconds"] for result in results if "error" not in result]
+    summary = {
+        "questions": len(results),
+        "answered": len(latencies),
+        "errors": len(results) - len(latencies),
+        "cached": sum(result["cached"] for result in results),
+        "load_seconds": round(load_seconds, 3),
+        "seconds": round(seconds, 3),
+        "questions_per_second": _rate(len(results), seconds),
+        "latency": {"p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99)},
+        "stages": {
+            stage: round(sum(result["timings"].get(stage, 0.0) for result in results), 3) for stage in QUERY_STAGES
+        },
+        "retrieval_batches": rag_engine.retrieval_batcher.stats(),
+    }
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["errors"] else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app", description="offline batch jobs for pdhelp.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="index pdf files or directory trees into the vector store.")
+    index.add_argument("paths", nargs="+", help="pdf files or directories to walk.")
+    index.add_argument("--workers", type=int, default=INGEST_WORKERS, help="documents indexed at once.")
+    index.add_argument("--tags", help="comma separated tags for every document.")
+    index.add_argument("--output", help="write one json result per file to this path.")
+    index.set_defaults(handler=index_command)
+
+    ask = commands.add_parser("ask", help="answer a jsonl file of questions.")
+    ask.add_argument("questions", help="jsonl file with one {\"question\": ...} object per line.")
+    ask.add_argument("--output", required=True, help="jsonl file to write answers and timings to.")
+    # more than the llm queue holds would be turned away instead of waiting
+    ask.add_argument("--concurrency", type=int, default=LLM_QUEUE_SIZE, help="questions in flight at once.")
+    ask.add_argument("--k", type=int)
+    ask.add_argument("--max-new-tokens", type=int)
+    ask.add_argument("--temperature", type=float)
+    # the api's deadline counts time in the queue, which a batch run spends
+    # most of; by default a question waits as long as it takes
+    ask.add_argument("--timeout", type=float, default=0, help="seconds per question, 0 for no limit.")
+    ask.set_defaults(handler=ask_command)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
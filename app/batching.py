@@ -0,0 +1,68 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+
+class MicroBatcher:
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], max_batch: int, max_wait: float, name: str):
+        self._handler = handler
+        self._max_batch = max(1, max_batch)
+        self._max_wait = max_wait
+        self._name = name
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+
+    def submit(self, item: Any) -> Any:
+        future = Future()
+        self._start()
+        self._queue.put((item, future))
+        return future.result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "average_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+            }
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List:
+        batch = [self._queue.get()]
+        # the window opens with the first request, so a lone request waits at most max_wait
+        deadline = time.monotonic() + self._max_wait
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+            try:
+                results = self._handler([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
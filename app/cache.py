@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+ANSWER_CACHE_SIZE = int(os.getenv("PDHELP_ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("PDHELP_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("PDHELP_ANSWER_CACHE_THRESHOLD", "0.95"))
+
+
+class _Entry:
+    __slots__ = ("vector", "value", "scope", "expires_at")
+
+    def __init__(self, vector: np.ndarray, value: Any, scope: Hashable, expires_at: float):
+        self.vector = vector
+        self.value = value
+        self.scope = scope
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, embedding: List[float], scope: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key, entry in list(self._entries.items()):
+                if entry.expires_at <= now:
+                    del self._entries[key]
+                    self.evictions += 1
+                    continue
+                if entry.scope != scope:
+                    continue
+                score = float(np.dot(vector, entry.vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return self._entries[best_key].value
+
+    def put(self, embedding: List[float], scope: Hashable, value: Any):
+        if not self.enabled:
+            return
+
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._entries[self._next_key] = _Entry(vector, value, scope, time.monotonic() + self.ttl)
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _normalize(self, embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class DocumentCatalog:
+    """Chunk and byte totals per document revision, kept as chunks are written
+    and deleted, so listing documents never reads the chunks themselves."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def add(self, texts: List[str], metadatas: List[Dict]):
+        totals: Dict = {}
+        for text, metadata in zip(texts, metadatas):
+            key = _document_key(metadata)
+            entry = totals.setdefault(
+                key,
+                [metadata.get("doc_id"), metadata.get("filename"), metadata.get("file_sha256"), metadata.get("tags", ""), 0, 0],
+            )
+            entry[4] += 1
+            entry[5] += len((text or "").encode("utf-8"))
+        if not totals:
+            return
+        with self._lock:
+            db = self._connect(create=True)
+            db.executemany(
+                "INSERT INTO revisions (key, revision, doc_id, filename, file_sha256, tags, chunks, bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key, revision) DO UPDATE SET "
+                "chunks = chunks + excluded.chunks, bytes = bytes + excluded.bytes",
+                [(key, revision, *entry) for (key, revision), entry in totals.items()],
+            )
+            db.commit()
+
+    def remove(self, doc_id: str, revision: Optional[str] = None, keep: Optional[str] = None):
+        # the whole document, one revision of it, or every revision but `keep`
+        condition, params = "key = ?", [doc_id]
+        if revision is not None:
+            condition, params = condition + " AND revision = ?", params + [revision]
+        if keep is not None:
+            condition, params = condition + " AND revision != ?", params + [keep]
+        with self._lock:
+            db = self._connect(create=False)
+            if db is None:
+                return
+            db.execute(f"DELETE FROM revisions WHERE {condition}", params)
+            db.commit()
+
+    def documents(self) -> List[Dict]:
+        with self._lock:
+            db = self._connect(create=False)
+            if db is None:
+                return []
+            rows = db.execute(
+                "SELECT key, doc_id, filename, file_sha256, tags, chunks, bytes FROM revisions ORDER BY rowid"
+            ).fetchall()
+        documents: "OrderedDict[str, Dict]" = OrderedDict()
+        for key, doc_id, filename, file_sha256, tags, chunks, size in rows:
+            document = documents.setdefault(key, {"chunks": 0, "bytes": 0})
+            # the newest revision names the document
+            document.update({
+                "doc_id": doc_id,
+                "filename": filename,
+                "file_sha256": file_sha256,
+                "tags": [tag for tag in (tags or "").split(",") if tag],
+            })
+            document["chunks"] += chunks
+            document["bytes"] += size
+        return [
+            {key: document[key] for key in ("doc_id", "filename", "file_sha256", "tags", "chunks", "bytes")}
+            for document in documents.values()
+        ]
+
+    def size(self) -> int:
+        with self._lock:
+            db = self._connect(create=False)
+            return db.execute("SELECT COUNT(*) FROM revisions").fetchone()[0] if db is not None else 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _connect(self, create: bool) -> Optional[sqlite3.Connection]:
+        if self._db is None:
+            if not create and not os.path.exists(self._path):
+                return None
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self._path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS revisions (key TEXT NOT NULL, revision TEXT NOT NULL, doc_id TEXT, "
+                "filename TEXT, file_sha256 TEXT, tags TEXT, chunks INTEGER NOT NULL, bytes INTEGER NOT NULL, "
+                "PRIMARY KEY (key, revision))"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+
+def _document_key(metadata: Dict):
+    # chunks stored before document ids are grouped by file instead
+    key = metadata.get("doc_id") or metadata.get("file_sha256") or ""
+    return key, metadata.get("revision") or ""
@@ -0,0 +1,192 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import requests
+
+BUFFER_SIZE = 1024 * 1024
+# reads stay small so a dropped connection loses little; writes are batched by the file buffer
+READ_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 60
+MIN_SEGMENT_BYTES = 32 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+RETRY_DELAY = 2.0
+PROGRESS_INTERVAL = 5.0
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class _Progress:
+    def __init__(self, total: Optional[int], done: int = 0):
+        self.total = total
+        self.done = done
+        self._last_report = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, count: int):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self._last_report >= PROGRESS_INTERVAL:
+                self._last_report = now
+                self.report()
+
+    def report(self):
+        if self.total:
+            print(f"downloaded {self.done / self.total:.0%} ({self.done // (1024 * 1024)} of {self.total // (1024 * 1024)} MB)")
+        else:
+            print(f"downloaded {self.done // (1024 * 1024)} MB")
+
+
+def probe(url: str) -> Tuple[Optional[int], bool]:
+    response = requests.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code >= 400:
+        return None, False
+    length = response.headers.get("Content-Length")
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(length) if length else None), accepts_ranges
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_file(
+    url: str,
+    dest: str,
+    segments: int = 1,
+    expected_sha256: Optional[str] = None,
+    min_segment_bytes: int = MIN_SEGMENT_BYTES,
+):
+    partial = dest + ".part"
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            _download_to_partial(url, partial, segments, min_segment_bytes)
+            break
+        except (requests.RequestException, IOError) as e:
+            # whatever reached the disk stays there and the next attempt resumes from it
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            print(f"download interrupted ({e}). resuming, attempt {attempt + 1} of {DOWNLOAD_RETRIES}")
+            time.sleep(RETRY_DELAY)
+
+    if expected_sha256:
+        actual = sha256_file(partial)
+        if actual != expected_sha256.lower():
+            os.remove(partial)
+            raise ChecksumError(f"checksum mismatch for {dest}: expected {expected_sha256}, got {actual}")
+
+    os.replace(partial, dest)
+
+
+def _download_to_partial(url: str, partial: str, segments: int, min_segment_bytes: int):
+    total, ranged = probe(url)
+    segments = min(segments, (total or 0) // max(min_segment_bytes, 1))
+
+    # an existing .part file is a prefix of the model, so it is always resumed as one stream
+    if ranged and total and segments > 1 and not os.path.exists(partial):
+        _download_segmented(url, partial, total, segments)
+    else:
+        # segments left by a merge that was interrupted are not needed any more
+        _remove_segments(partial)
+        _download_stream(url, partial, total, ranged)
+
+    if total is not None and os.path.getsize(partial) != total:
+        raise IOError(f"incomplete download: {os.path.getsize(partial)} of {total} bytes")
+
+
+def _download_stream(url: str, partial: str, total: Optional[int], ranged: bool):
+    existing = os.path.getsize(partial) if ranged and os.path.exists(partial) else 0
+    if total is not None and existing > total:
+        # not a prefix of the file, so resuming it could never finish
+        print(f"discarding {partial}: {existing} bytes is more than the {total} expected")
+        os.remove(partial)
+        existing = 0
+    if total is not None and existing == total:
+        return
+
+    headers = {"Range": f"bytes={existing}-"} if existing else {}
+    response = requests.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 206:
+        mode = "ab"
+        print(f"resuming download at {existing // (1024 * 1024)} MB")
+    elif response.status_code == 200:
+        mode, existing = "wb", 0
+    else:
+        raise Exception(f"failed to download model. status: {response.status_code}")
+
+    progress = _Progress(total, existing)
+    with open(partial, mode, buffering=BUFFER_SIZE) as f:
+        for chunk in response.iter_content(chunk_size=READ_SIZE):
+            f.write(chunk)
+            progress.add(len(chunk))
+    progress.report()
+
+
+def _download_segmented(url: str, partial: str, total: int, segments: int):
+    size = -(-total // segments)
+    ranges = [(start, min(start + size, total) - 1) for start in range(0, total, size)]
+    # the byte range is part of the name so leftovers from a different split are never mixed in
+    paths = [f"{partial}.{start}-{end}" for start, end in ranges]
+
+    progress = _Progress(total, sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="download") as pool:
+        futures = [
+            pool.submit(_download_range, url, path, start, end, progress)
+            for path, (start, end) in zip(paths, ranges)
+        ]
+        for future in futures:
+            future.result()
+    progress.report()
+
+    # a server that ignores the range end would make the merged file too long,
+    # so bad segments are dropped and fetched again on the next attempt
+    wrong = [
+        (path, start, end) for path, (start, end) in zip(paths, ranges) if os.path.getsize(path) != end - start + 1
+    ]
+    for path, _, _ in wrong:
+        os.remove(path)
+    if wrong:
+        _, start, end = wrong[0]
+        raise IOError(f"{len(wrong)} segments had the wrong size, the first is bytes {start}-{end}")
+
+    with open(partial, "wb", buffering=BUFFER_SIZE) as out:
+        for path in paths:
+            with open(path, "rb") as segment:
+                for block in iter(lambda: segment.read(BUFFER_SIZE), b""):
+                    out.write(block)
+    _remove_segments(partial)
+
+
+def _remove_segments(partial: str):
+    for path in glob.glob(glob.escape(partial) + ".*-*"):
+        os.remove(path)
+
+
+def _download_range(url: str, path: str, start: int, end: int, progress: _Progress):
+    existing = os.path.getsize(path) if os.path.exists(path) else 0
+    if start + existing > end + 1:
+        os.remove(path)
+        existing = 0
+    if start + existing > end:
+        return
+
+    headers = {"Range": f"bytes={start + existing}-{end}"}
+    response = requests.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 206:
+        raise IOError(f"range request failed. status: {response.status_code}")
+
+    with open(path, "ab", buffering=BUFFER_SIZE) as f:
+        for chunk in response.iter_content(chunk_size=READ_SIZE):
+            f.write(chunk)
+            progress.add(len(chunk))
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+SQLITE_MAX_PARAMS = 500
+
+
+class PooledEmbeddings(Embeddings):
+    def __init__(self, model, processes: int, batch_size: int, normalize: bool):
+        self._model = model
+        self._batch_size = batch_size
+        self._normalize = normalize
+        # started once and reused: langchain's multi_process flag spawns a new pool on every call
+        self._pool = model.start_multi_process_pool(target_devices=["cpu"] * processes)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self._model.encode_multi_process(
+            texts,
+            self._pool,
+            batch_size=self._batch_size,
+            normalize_embeddings=self._normalize,
+        )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        # a single sentence is cheaper to encode in-process than to ship to a worker
+        vector = self._model.encode(text, batch_size=1, normalize_embeddings=self._normalize)
+        return vector.tolist()
+
+    def close(self):
+        if self._pool is not None:
+            self._model.stop_multi_process_pool(self._pool)
+            self._pool = None
+
+
+class DeferredEmbeddings(Embeddings):
+    def __init__(self):
+        self._loaded = threading.Event()
+        self._inner: Optional[Embeddings] = None
+        self._error: Optional[Exception] = None
+
+    def resolve(self, inner: Embeddings):
+        self._inner = inner
+        self._loaded.set()
+
+    def fail(self, error: Exception):
+        self._error = error
+        self._loaded.set()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._wait().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._wait().embed_query(text)
+
+    def _wait(self) -> Embeddings:
+        self._loaded.wait()
+        if self._inner is None:
+            raise RuntimeError(f"embeddings failed to load: {self._error}")
+        return self._inner
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, inner: Embeddings, model_name: str, path: str, max_entries: int):
+        self._inner = inner
+        self._model_name = model_name
+        self._path = path
+        self._max_entries = max_entries
+        self._db: Optional[sqlite3.Connection] = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            cached = self._load(list(set(keys)))
+
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+
+        if missing:
+            # embed outside the lock so cache reads are never stuck behind the transformer
+            vectors = self._inner.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                self._store(fresh)
+            cached.update(fresh)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._inner.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # questions are one-off, so like embed_query they are not worth persisting
+        return self._inner.embed_documents(texts)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"size": self._size, "max_entries": self._max_entries, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        if hasattr(self._inner, "close"):
+            self._inner.close()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self._model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # opened on first use so loading the engine never touches the disk
+        if self._db is None:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self._path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._size = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._db = db
+        return self._db
+
+    def _load(self, keys: List[str]) -> Dict[str, List[float]]:
+        db = self._connect()
+        found = {}
+        for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+            part = keys[start : start + SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(part))
+            rows = db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+            if rows:
+                db.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                    [time.time(), *part],
+                )
+        db.commit()
+        return found
+
+    def _store(self, vectors: Dict[str, List[float]]):
+        db = self._connect()
+        now = time.time()
+        before = db.total_changes
+        db.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            [(key, array("f", vector).tobytes(), now) for key, vector in vectors.items()],
+        )
+        self._size += db.total_changes - before
+
+        overflow = self._size - self._max_entries
+        if overflow > 0:
+            db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (overflow,),
+            )
+            self._size -= overflow
+        db.commit()
@@ -0,0 +1,383 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.rag import RagEngine, normalize_tags, rag_engine, tag_metadata
+
+INGEST_WORKERS = int(os.getenv("PDHELP_INGEST_WORKERS", "2"))
+INGEST_QUEUE_SIZE = int(os.getenv("PDHELP_INGEST_QUEUE_SIZE", "16"))
+JOB_HISTORY_SIZE = 200
+BULK_HISTORY_SIZE = 50
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def document_metadata(doc_id: str, revision: str, filename: str, file_sha256: str, tags: Optional[List[str]] = None) -> Dict:
+    return {
+        "doc_id": doc_id,
+        "revision": revision,
+        "file_sha256": file_sha256,
+        "filename": filename,
+        **tag_metadata(tags),
+    }
+
+
+def discard_partial(engine: RagEngine, doc_id: str, filename: str, revision: Optional[str] = None):
+    # chunks stored before a failure carry the file hash, so the next upload
+    # of the same file would be reported as already indexed. a failed
+    # replacement only drops its own revision and the old one stays whole
+    try:
+        if revision:
+            removed = engine.delete_revision(doc_id, revision)
+        else:
+            removed = engine.delete_document(doc_id)
+    except Exception as e:
+        print(f"error removing partial chunks of {filename}: {e}")
+        return
+    if removed:
+        print(f"removed {removed} partial chunks of {filename}")
+
+
+class IngestionJob:
+    def __init__(
+        self,
+        filename: str,
+        file_path: str,
+        file_sha256: str,
+        tags: Optional[List[str]] = None,
+        doc_id: Optional[str] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        # a job given an existing document id replaces that document
+        self.replaces = doc_id is not None
+        self.doc_id = doc_id or uuid.uuid4().hex
+        self.filename = filename
+        self.file_path = file_path
+        self.file_sha256 = file_sha256
+        self.tags = normalize_tags(tags)
+        self.status = "queued"
+        self.pages_parsed = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_persisted = 0
+        self.chunks_removed = 0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def advance(self, stage: str, count: int):
+        with self._lock:
+            setattr(self, stage, getattr(self, stage) + count)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "doc_id": self.doc_id,
+                "filename": self.filename,
+                "tags": self.tags,
+                "replaces": self.replaces,
+                "file_sha256": self.file_sha256,
+                "status": self.status,
+                "pages_parsed": self.pages_parsed,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "chunks_persisted": self.chunks_persisted,
+                "chunks_removed": self.chunks_removed,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class BulkUpload:
+    def __init__(self, tags: Optional[List[str]] = None):
+        self.id = uuid.uuid4().hex
+        self.tags = normalize_tags(tags)
+        self.files: List[Dict] = []
+        self.feeding = True
+        self.created_at = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, filename: str, status: str, job: Optional[IngestionJob] = None, size: int = 0, **details):
+        with self._lock:
+            self.files.append({"filename": filename, "status": status, "job": job, "bytes": size, **details})
+
+    def close(self):
+        with self._lock:
+            self.feeding = False
+
+    @property
+    def finished(self) -> bool:
+        with self._lock:
+            return not self.feeding and all(entry["job"] is None or entry["job"].finished for entry in self.files)
+
+    def to_dict(self) -> Dict:
+        finished = self.finished
+        with self._lock:
+            files = []
+            for entry in self.files:
+                job = entry["job"]
+                details = {key: value for key, value in entry.items() if key != "job"}
+                if job is not None:
+                    details.update({key: value for key, value in job.to_dict().items() if key != "filename"})
+                files.append(details)
+
+        ingested = [entry for entry in files if "job_id" in entry]
+        ended = [entry["finished_at"] for entry in ingested if entry["finished_at"]]
+        seconds = (max(ended) if finished and ended else time.time()) - self.created_at
+        chunks = sum(entry["chunks_persisted"] for entry in ingested)
+        completed = [entry for entry in ingested if entry["status"] == "completed"]
+        size = sum(entry["bytes"] for entry in completed)
+        return {
+            "bulk_id": self.id,
+            "status": "completed" if finished else "running",
+            "tags": self.tags,
+            "files": files,
+            "summary": {
+                "files": len(files),
+                **Counter(entry["status"] for entry in files),
+                "pages_parsed": sum(entry["pages_parsed"] for entry in ingested),
+                "chunks_persisted": chunks,
+                "bytes": size,
+                "seconds": round(seconds, 3),
+                "files_per_second": round(len(completed) / seconds, 3) if seconds > 0 else 0.0,
+                "chunks_per_second": round(chunks / seconds, 3) if seconds > 0 else 0.0,
+                "megabytes_per_second": round(size / (1024 * 1024) / seconds, 3) if seconds > 0 else 0.0,
+            },
+        }
+
+
+def extract_pdfs(archive_path: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    # members are copied out one at a time so an archive never sits in memory
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = info.filename
+            if not name.lower().endswith(".pdf") or os.path.basename(name).startswith("._"):
+                yield name, None, None
+                continue
+            digest = hashlib.sha256()
+            with archive.open(info) as member, tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+                while True:
+                    block = member.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    digest.update(block)
+                    temp_file.write(block)
+            yield name, temp_file.name, digest.hexdigest()
+
+
+class IngestionQueue:
+    def __init__(self, engine: RagEngine, workers: int = INGEST_WORKERS, max_pending: int = INGEST_QUEUE_SIZE):
+        self._engine = engine
+        self._workers = workers
+        # a slot is held from submit until the job finishes, so at most
+        # `workers` jobs run and `max_pending` wait at any time
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._bulks: "OrderedDict[str, BulkUpload]" = OrderedDict()
+        # new documents by file hash until their chunks are stored, since the
+        # store cannot tell a second upload of the file apart before that
+        self._pending: Dict[str, IngestionJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ingest")
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(
+        self,
+        filename: str,
+        file_path: str,
+        file_sha256: str,
+        tags: Optional[List[str]] = None,
+        doc_id: Optional[str] = None,
+        block: bool = False,
+    ) -> IngestionJob:
+        if doc_id is None:
+            pending = self.find_pending(file_sha256)
+            if pending is not None:
+                os.remove(file_path)
+                return pending
+        if not self._slots.acquire(blocking=block):
+            raise QueueFullError("ingestion queue is full. try again later.")
+
+        job = IngestionJob(filename, file_path, file_sha256, tags, doc_id)
+        try:
+            self.start()
+            with self._lock:
+                pending = None if job.replaces else self._pending.get(file_sha256)
+                if pending is not None:
+                    # the same file was submitted while this one waited for a slot
+                    self._slots.release()
+                    os.remove(file_path)
+                    return pending
+                if not job.replaces:
+                    self._pending[file_sha256] = job
+                self._jobs[job.id] = job
+                self._trim_history()
+                self._executor.submit(self._run, job)
+        except Exception:
+            self._slots.release()
+            raise
+        return job
+
+    def find_pending(self, file_sha256: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._pending.get(file_sha256)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            statuses = Counter(job.status for job in self._jobs.values())
+        return {"workers": self._workers, "queued": statuses["queued"], "running": statuses["running"]}
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit_bulk(self, uploads: List[Tuple[str, Optional[str], Optional[str]]], tags: Optional[List[str]] = None) -> BulkUpload:
+        # uploads are (filename, saved path, sha256); zip archives are
+        # expanded by the feeder, which hands files to the workers as slots free up
+        bulk = BulkUpload(tags)
+        with self._lock:
+            self._bulks[bulk.id] = bulk
+            while len(self._bulks) > BULK_HISTORY_SIZE:
+                oldest = next((bulk_id for bulk_id, item in self._bulks.items() if item.finished), None)
+                if oldest is None:
+                    break
+                del self._bulks[oldest]
+        threading.Thread(target=self._feed, args=(bulk, uploads), name=f"bulk-{bulk.id[:8]}", daemon=True).start()
+        return bulk
+
+    def get_bulk(self, bulk_id: str) -> Optional[BulkUpload]:
+        with self._lock:
+            return self._bulks.get(bulk_id)
+
+    def _feed(self, bulk: BulkUpload, uploads: List[Tuple[str, Optional[str], Optional[str]]]):
+        seen = set()
+        try:
+            for filename, path, file_sha256 in uploads:
+                if path is not None and filename.lower().endswith(".zip"):
+                    try:
+                        for name, member_path, member_sha256 in extract_pdfs(path):
+                            self._feed_file(bulk, seen, name, member_path, member_sha256)
+                    except zipfile.BadZipFile:
+                        bulk.record(filename, "rejected", error="not a valid zip archive.")
+                    finally:
+                        os.remove(path)
+                else:
+                    self._feed_file(bulk, seen, filename, path, file_sha256)
+        except Exception as e:
+            print(f"error feeding bulk upload {bulk.id}: {e}")
+            bulk.record("", "failed", error=str(e))
+        finally:
+            bulk.close()
+
+    def _feed_file(self, bulk: BulkUpload, seen: set, filename: str, path: Optional[str], file_sha256: Optional[str]):
+        if path is None:
+            bulk.record(filename, "skipped", error="only pdf files are supported.")
+            return
+        size = os.path.getsize(path)
+        if size == 0 or file_sha256 in seen:
+            os.remove(path)
+            bulk.record(filename, "rejected" if size == 0 else "duplicate", file_sha256=file_sha256)
+            return
+        seen.add(file_sha256)
+
+        existing = self._engine.find_document(file_sha256)
+        if existing is not None:
+            os.remove(path)
+            bulk.record(filename, "already_indexed", doc_id=existing["doc_id"], file_sha256=file_sha256)
+            return
+        pending = self.find_pending(file_sha256)
+        if pending is not None:
+            os.remove(path)
+            bulk.record(filename, "already_queued", doc_id=pending.doc_id, file_sha256=file_sha256)
+            return
+        try:
+            job = self.submit(filename, path, file_sha256, bulk.tags, block=True)
+        except Exception as e:
+            os.remove(path)
+            bulk.record(filename, "failed", error=str(e), file_sha256=file_sha256)
+            return
+        bulk.record(filename, "queued", job=job, size=size)
+
+    def _trim_history(self):
+        if len(self._jobs) <= JOB_HISTORY_SIZE:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished]:
+            del self._jobs[job_id]
+            if len(self._jobs) <= JOB_HISTORY_SIZE:
+                break
+
+    def _run(self, job: IngestionJob):
+        job.status = "running"
+        job.started_at = time.time()
+        stored = False
+        try:
+            existing = None if job.replaces else self._engine.find_document(job.file_sha256)
+            if existing is not None:
+                # a copy finished between the upload's check and this job starting
+                print(f"{job.filename} was indexed meanwhile as {existing['doc_id']}")
+                job.doc_id = existing["doc_id"]
+                job.status = "completed"
+                return
+            chunk_count = self._engine.ingest_document(
+                job.file_path,
+                on_progress=job.advance,
+                metadata=document_metadata(job.doc_id, job.id, job.filename, job.file_sha256, job.tags),
+            )
+            if not chunk_count:
+                raise ValueError("document appears to be empty or unreadable.")
+            stored = True
+            if job.replaces:
+                # the new revision was written under its own ids, so the old
+                # one is whole until this point
+                job.chunks_removed = self._engine.prune_document(job.doc_id, job.id)
+            job.status = "completed"
+        except Exception as e:
+            print(f"error ingesting {job.filename}: {e}")
+            job.error = str(e)
+            job.status = "failed"
+            # nothing was written unless a batch was started; once the new
+            # revision is complete it is kept even if pruning the old one failed
+            if job.chunks_total and not stored:
+                discard_partial(self._engine, job.doc_id, job.filename, job.id if job.replaces else None)
+        finally:
+            job.finished_at = time.time()
+            if os.path.exists(job.file_path):
+                os.remove(job.file_path)
+            with self._lock:
+                if self._pending.get(job.file_sha256) is job:
+                    del self._pending[job.file_sha256]
+            self._slots.release()
+
+
+ingestion_queue = IngestionQueue(rag_engine)
@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# part numbers and error codes ("PN-1234", "E_42") stay single tokens; the
+# pattern splits text the same way the fts5 tokenizer below does
+TOKEN_PATTERN = re.compile(r"[\w-]+")
+TOKENIZER = "unicode61 remove_diacritics 0 tokenchars '-_'"
+# common terms carry little signal but have the longest posting lists, which
+# is what a lookup pays for, so they are left out of the query; the vector
+# search already covers ordinary wording
+MAX_TERM_SHARE = 0.2
+MAX_TERM_DOCS = 20000
+MAX_QUERY_TERMS = 16
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it of on or should the this to was what when "
+    "where which who why will with you your".split()
+)
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def add(self, ids: List[str], texts: List[str], metadatas: List[Dict]):
+        with self._lock:
+            db = self._connect(create=True)
+            new_rows, updated_rows = [], []
+            for chunk_id, text, metadata in zip(ids, texts, metadatas):
+                # rowids come from the content hash, so a known rowid means the same text
+                rowid = self._rowid(chunk_id)
+                if db.execute("SELECT 1 FROM chunks WHERE rowid = ?", (rowid,)).fetchone():
+                    updated_rows.append((json.dumps(metadata), rowid))
+                else:
+                    new_rows.append((rowid, text, chunk_id, json.dumps(metadata)))
+
+            db.executemany("UPDATE chunks SET metadata = ? WHERE rowid = ?", updated_rows)
+            db.executemany("INSERT INTO chunks (rowid, text, chunk_id, metadata) VALUES (?, ?, ?, ?)", new_rows)
+            frequencies = Counter(term for row in new_rows for term in set(TOKEN_PATTERN.findall(row[1].lower())))
+            db.executemany(
+                "INSERT INTO terms (term, docs) VALUES (?, ?) ON CONFLICT (term) DO UPDATE SET docs = docs + excluded.docs",
+                frequencies.items(),
+            )
+            db.execute("UPDATE stats SET chunks = chunks + ?", (len(new_rows),))
+            db.commit()
+
+    def search(self, query: str, k: int, where: Optional[Dict] = None) -> List[Tuple[str, str, Dict, float]]:
+        with self._lock:
+            db = self._connect(create=False)
+            if db is None:
+                return []
+            terms = self._query_terms(db, query)
+            if not terms:
+                return []
+            condition, params = _where_sql(where) if where else ("1", [])
+            rows = db.execute(
+                "SELECT chunk_id, text, metadata, bm25(chunks) FROM chunks "
+                f"WHERE chunks MATCH ? AND {condition} ORDER BY rank LIMIT ?",
+                (" OR ".join(f'"{term}"' for term in terms), *params, k),
+            ).fetchall()
+        # bm25() is lower for better matches; flip it so larger means better
+        return [(chunk_id, text, json.loads(metadata), -score) for chunk_id, text, metadata, score in rows]
+
+    def delete(self, ids: List[str]) -> int:
+        with self._lock:
+            db = self._connect(create=False)
+            if db is None:
+                return 0
+            texts = []
+            for chunk_id in ids:
+                rowid = self._rowid(chunk_id)
+                row = db.execute("SELECT text FROM chunks WHERE rowid = ?", (rowid,)).fetchone()
+                if row is not None:
+                    texts.append(row[0])
+                    db.execute("DELETE FROM chunks WHERE rowid = ?", (rowid,))
+            frequencies = Counter(term for text in texts for term in set(TOKEN_PATTERN.findall(text.lower())))
+            db.executemany("UPDATE terms SET docs = docs - ? WHERE term = ?", [(n, term) for term, n in frequencies.items()])
+            db.execute("DELETE FROM terms WHERE docs <= 0")
+            db.execute("UPDATE stats SET chunks = MAX(chunks - ?, 0)", (len(texts),))
+            db.commit()
+            return len(texts)
+
+    def compact(self):
+        with self._lock:
+            db = self._connect(create=False)
+            if db is None:
+                return
+            # fts5 deletes leave tombstones in the segment b-trees that every
+            # match still walks; merging the segments drops them for good
+            db.execute("INSERT INTO chunks (chunks) VALUES ('optimize')")
+            db.commit()
+            db.execute("VACUUM")
+
+    def size(self) -> int:
+        with self._lock:
+            db = self._connect(create=False)
+            return db.execute("SELECT chunks FROM stats").fetchone()[0] if db is not None else 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _query_terms(self, db: sqlite3.Connection, query: str) -> List[str]:
+        total = db.execute("SELECT chunks FROM stats").fetchone()[0]
+        limit = min(MAX_TERM_DOCS, total * MAX_TERM_SHARE) if total > 100 else total
+        terms = []
+        for term in dict.fromkeys(TOKEN_PATTERN.findall(query.lower())):
+            if term in STOPWORDS:
+                continue
+            # fts5vocab would count a term's documents by walking its whole
+            # posting list, so frequencies are kept in a plain table instead
+            row = db.execute("SELECT docs FROM terms WHERE term = ?", (term,)).fetchone()
+            if row is None or row[0] > limit:
+                continue
+            terms.append(term)
+            if len(terms) == MAX_QUERY_TERMS:
+                break
+        return terms
+
+    @staticmethod
+    def _rowid(chunk_id: str) -> int:
+        return int(chunk_id[:15], 16)
+
+    def _connect(self, create: bool) -> Optional[sqlite3.Connection]:
+        # searches before anything was indexed should not create files
+        if self._db is None:
+            if not create and not os.path.exists(self._path):
+                return None
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self._path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+                f"text, chunk_id UNINDEXED, metadata UNINDEXED, tokenize=\"{TOKENIZER}\")"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID")
+            # counting rows of an fts5 table scans it, so the total is kept here
+            db.execute("CREATE TABLE IF NOT EXISTS stats (chunks INTEGER NOT NULL)")
+            if db.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 0:
+                db.execute("INSERT INTO stats (chunks) VALUES (0)")
+            db.commit()
+            self._db = db
+        return self._db
+
+
+def _where_sql(where: Dict) -> Tuple[str, List]:
+    # the subset of chroma's `where` syntax that query filters produce,
+    # matched against the json metadata stored with each chunk
+    clauses, params = [], []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(clause) for clause in value]
+            clauses.append("(" + f" {key[1:].upper()} ".join(sql for sql, _ in parts) + ")")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        column = "json_extract(metadata, ?)"
+        path = "$." + json.dumps(key)
+        operator, operand = next(iter(value.items())) if isinstance(value, dict) else ("$eq", value)
+        if operator == "$eq":
+            clauses.append(f"{column} = ?")
+            params.extend([path, operand])
+        elif operator == "$in":
+            clauses.append(f"{column} IN ({', '.join('?' for _ in operand)})")
+            params.extend([path, *operand])
+        else:
+            raise ValueError(f"unsupported filter operator {operator!r}")
+    return "(" + " AND ".join(clauses) + ")", params
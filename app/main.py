@@ -1,23 +1,39 @@
+import asyncio
+import hashlib
+import hmac
+import json
 import os
-import shutil
 import tempfile
+import threading
 from contextlib import asynccontextmanager
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
-from app.rag import rag_engine
+from app import metrics, pdf, profiling
+from app.ingest import QueueFullError, ingestion_queue
+from app.embeddings import CachedEmbeddings
+from app.rag import InferenceError, InferenceQueueFullError, rag_engine
+
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+DISCONNECT_POLL_SECONDS = 0.5
+# admin endpoints stay hidden unless a token is configured
+ADMIN_TOKEN = os.getenv("PDHELP_ADMIN_TOKEN", "")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Starting application. Thanks for using pdHelp! Follow @joshmode on GitHub for more")
-    rag_engine.initialize()
-    if rag_engine.vector_store is None or rag_engine.llm is None:
-        raise RuntimeError("initialization failed. check logs for details.")
+    # models load in the background; /ready reports progress and endpoints
+    # answer 503 until the components they need are up
+    rag_engine.start_loading()
+    ingestion_queue.start()
     yield
+    ingestion_queue.shutdown()
+    pdf.shutdown_pool()
 
 
 app = FastAPI(title="pdhelp by @joshmode", description="a tool to help with pdfs.", lifespan=lifespan)
@@ -27,60 +43,387 @@ class QueryRequest(BaseModel):
     text: Optional[str] = None
     question: Optional[str] = None
     query: Optional[str] = None
+    k: Optional[int] = Field(default=None, ge=1, le=20)
+    max_new_tokens: Optional[int] = Field(default=None, ge=1, le=1024)
+    max_tokens: Optional[int] = Field(default=None, ge=1, le=1024)
+    temperature: Optional[float] = Field(default=None, ge=0.0, le=2.0)
+    doc_id: Optional[str] = None
+    doc_ids: Optional[List[str]] = None
+    tags: Optional[List[str]] = None
+
+    def overrides(self) -> dict:
+        overrides = self.model_dump(include={"k", "max_new_tokens", "temperature", "tags"}, exclude_none=True)
+        if self.max_tokens is not None and self.max_new_tokens is None:
+            overrides["max_new_tokens"] = self.max_tokens
+        doc_ids = (self.doc_ids or []) + ([self.doc_id] if self.doc_id else [])
+        if doc_ids:
+            overrides["doc_ids"] = doc_ids
+        return overrides
 
 
 class QueryResponse(BaseModel):
     reply: str
 
 
-@app.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
+def _require_components(*names: str):
+    for name in names:
+        status = rag_engine.components[name]
+        if status.state == "failed":
+            raise HTTPException(status_code=503, detail=f"{name} failed to load: {status.error}")
+        if status.state != "ready":
+            raise HTTPException(status_code=503, detail=f"{name} is still loading.", headers={"Retry-After": "5"})
+
+
+def _save_upload(file: UploadFile, suffix: str = ".pdf") -> Tuple[str, str]:
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+        while True:
+            block = file.file.read(UPLOAD_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            temp_file.write(block)
+        return temp_file.name, digest.hexdigest()
+
+
+def _check_pdf(file: UploadFile):
     if not file.filename or not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="only pdf files are supported.")
 
-    temp_file_path = None
-    try:
-        file.file.seek(0, 2)
-        file_size = file.file.tell()
-        file.file.seek(0)
+    file.file.seek(0, 2)
+    file_size = file.file.tell()
+    file.file.seek(0)
 
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="uploaded file is empty.")
+    if file_size == 0:
+        raise HTTPException(status_code=400, detail="uploaded file is empty.")
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            shutil.copyfileobj(file.file, temp_file)
-            temp_file_path = temp_file.name
 
-        chunks = rag_engine.process_document(temp_file_path)
-        if not chunks:
-            raise HTTPException(status_code=400, detail="document appears to be empty or unreadable.")
+def _submit_upload(file: UploadFile, temp_file_path: str, file_sha256: str, tags: Optional[str], doc_id=None):
+    try:
+        # tags arrive as one comma separated form field
+        return ingestion_queue.submit(file.filename, temp_file_path, file_sha256, (tags or "").split(","), doc_id)
+    except QueueFullError as e:
+        os.remove(temp_file_path)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    except Exception as e:
+        os.remove(temp_file_path)
+        raise HTTPException(status_code=500, detail=f"error processing file: {str(e)}")
 
-        rag_engine.add_documents(chunks)
 
-    except HTTPException:
-        raise
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=str(e))
+@app.post("/upload", status_code=202)
+async def upload_document(file: UploadFile = File(...), tags: Optional[str] = Form(None)):
+    _check_pdf(file)
+    _require_components("embeddings", "vector_store")
+    temp_file_path, file_sha256 = await run_in_threadpool(_save_upload, file)
+    try:
+        existing = await run_in_threadpool(rag_engine.find_document, file_sha256)
+        if existing is not None:
+            os.remove(temp_file_path)
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "message": "document already indexed",
+                    "doc_id": existing["doc_id"],
+                    "filename": file.filename,
+                    "file_sha256": file_sha256,
+                },
+            )
     except Exception as e:
+        os.remove(temp_file_path)
         raise HTTPException(status_code=500, detail=f"error processing file: {str(e)}")
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+    job = _submit_upload(file, temp_file_path, file_sha256, tags)
+
+    return {
+        # a second upload of a file still being indexed joins the first job
+        "message": "document queued for processing" if job.file_path == temp_file_path else "document already queued",
+        "job_id": job.id,
+        "doc_id": job.doc_id,
+        "filename": file.filename,
+        "file_sha256": file_sha256,
+        "tags": job.tags,
+    }
+
+
+@app.post("/upload/bulk", status_code=202)
+async def upload_bulk(files: List[UploadFile] = File(...), tags: Optional[str] = Form(None)):
+    _require_components("embeddings", "vector_store")
+    # starlette spools each part to disk while parsing, and parts are copied
+    # out one block at a time, so the request body is never held in memory
+    uploads = []
+    try:
+        for file in files:
+            name = file.filename or ""
+            if name.lower().endswith((".pdf", ".zip")):
+                temp_file_path, file_sha256 = await run_in_threadpool(_save_upload, file, os.path.splitext(name)[1])
+                uploads.append((name, temp_file_path, file_sha256))
+            else:
+                uploads.append((name, None, None))
+    except Exception as e:
+        for _, temp_file_path, _ in uploads:
+            if temp_file_path:
+                os.remove(temp_file_path)
+        raise HTTPException(status_code=500, detail=f"error saving upload: {str(e)}")
+
+    bulk = ingestion_queue.submit_bulk(uploads, (tags or "").split(","))
+    return bulk.to_dict()
+
+
+@app.get("/upload/bulk/{bulk_id}")
+def get_bulk_upload(bulk_id: str):
+    bulk = ingestion_queue.get_bulk(bulk_id)
+    if bulk is None:
+        raise HTTPException(status_code=404, detail="bulk upload not found.")
+    return bulk.to_dict()
+
+
+@app.get("/documents")
+def list_documents():
+    _require_components("vector_store")
+    return {"documents": rag_engine.list_documents(), "compaction": rag_engine.compaction_status()}
+
+
+@app.put("/documents/{doc_id}", status_code=202)
+async def replace_document(doc_id: str, file: UploadFile = File(...), tags: Optional[str] = Form(None)):
+    _check_pdf(file)
+    _require_components("embeddings", "vector_store")
+    document = await run_in_threadpool(rag_engine.get_document, doc_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="document not found.")
+    if tags is None:
+        # a replacement without a tags field keeps the document's tags
+        tags = ",".join(document["tags"])
+
+    temp_file_path, file_sha256 = await run_in_threadpool(_save_upload, file)
+    job = _submit_upload(file, temp_file_path, file_sha256, tags, doc_id)
+    return {
+        "message": "document queued for replacement",
+        "job_id": job.id,
+        "doc_id": job.doc_id,
+        "filename": file.filename,
+        "file_sha256": file_sha256,
+        "tags": job.tags,
+    }
+
+
+@app.delete("/documents/{doc_id}")
+def delete_document(doc_id: str):
+    _require_components("vector_store")
+    deleted = rag_engine.delete_document(doc_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="document not found.")
+    return {"message": "document deleted", "doc_id": doc_id, "chunks_deleted": deleted}
+
+
+@app.post("/documents/compact", status_code=202)
+def compact_documents():
+    _require_components("vector_store")
+    started = rag_engine.start_compaction()
+    return {"started": started, **rag_engine.compaction_status()}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found.")
+    return job.to_dict()
+
+
+def _inference_http_error(error: InferenceError) -> HTTPException:
+    status_code = 429 if isinstance(error, InferenceQueueFullError) else 503
+    return HTTPException(status_code=status_code, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+
+async def _cancel_on_disconnect(request: Request, cancel: threading.Event):
+    while not cancel.is_set():
+        if await request.is_disconnected():
+            cancel.set()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
 
-    return {"message": "document processed successfully", "filename": file.filename}
+_stream_watchers = set()
+
+
+def _locked(lock: threading.Lock, fn, *args):
+    with lock:
+        return fn(*args)
+
+
+async def _close_stream_when_cancelled(request: Request, cancel: threading.Event, events, step: threading.Lock):
+    await _cancel_on_disconnect(request, cancel)
+    # a generator paused at a token holds its model instance until it is
+    # closed; waiting for the lock lets a running next see the flag first
+    await run_in_threadpool(_locked, step, events.close)
 
 
 @app.post("/query", response_model=QueryResponse)
-def query_llm(request: QueryRequest):
+async def query_llm(request: QueryRequest, raw_request: Request):
     prompt = (request.text or request.question or request.query or "").strip()
     if not prompt:
         raise HTTPException(status_code=422, detail="please provide a question.")
 
+    _require_components("embeddings", "vector_store", "llm")
+    cancel = threading.Event()
+    watcher = asyncio.create_task(_cancel_on_disconnect(raw_request, cancel))
     try:
-        answer = rag_engine.query(prompt)
+        answer = await run_in_threadpool(rag_engine.query, prompt, cancel=cancel, **request.overrides())
         return QueryResponse(reply=answer)
+    except InferenceError as e:
+        raise _inference_http_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"error generating answer: {str(e)}")
+    finally:
+        cancel.set()
+        watcher.cancel()
+
+
+def _format_sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/query/stream")
+async def query_llm_stream(request: QueryRequest, raw_request: Request):
+    prompt = (request.text or request.question or request.query or "").strip()
+    if not prompt:
+        raise HTTPException(status_code=422, detail="please provide a question.")
+
+    _require_components("embeddings", "vector_store", "llm")
+    cancel = threading.Event()
+    events = rag_engine.stream_query(prompt, cancel=cancel, **request.overrides())
+    # next and close must not overlap, or close fails on a running generator
+    step = threading.Lock()
+    # the watcher covers the queue wait as well as the stream, and is what
+    # closes the generator in the end
+    watcher = asyncio.create_task(_close_stream_when_cancelled(raw_request, cancel, events, step))
+    # the event loop only keeps weak references to tasks
+    _stream_watchers.add(watcher)
+    watcher.add_done_callback(_stream_watchers.discard)
+    try:
+        # run retrieval and queueing before the response starts so failures still map to a status code
+        first = await run_in_threadpool(_locked, step, next, events, None)
+    except InferenceError as e:
+        cancel.set()
+        raise _inference_http_error(e)
+    except Exception as e:
+        cancel.set()
+        raise HTTPException(status_code=500, detail=f"error generating answer: {str(e)}")
+
+    async def event_stream():
+        try:
+            if first is not None:
+                yield _format_sse(first["event"], first["data"])
+            while True:
+                item = await run_in_threadpool(_locked, step, next, events, None)
+                if item is None:
+                    break
+                yield _format_sse(item["event"], item["data"])
+        except InferenceError as e:
+            yield _format_sse("error", str(e))
+            return
+        except Exception as e:
+            print(f"error during streaming qa: {e}")
+            yield _format_sse("error", "error processing request")
+            return
+        finally:
+            # only runs if this generator is resumed or closed, which starlette
+            # does not do when the client leaves while it waits at a yield
+            cancel.set()
+        yield _format_sse("done", {})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return rag_engine.answer_cache.stats()
+
+
+@app.get("/inference/stats")
+def inference_stats():
+    return {**rag_engine.inference.stats(), "retrieval_batches": rag_engine.retrieval_batcher.stats()}
+
+
+def _runtime_metrics():
+    inference = rag_engine.inference.stats()
+    yield "pdhelp_inference_instances", "gauge", "Loaded model instances.", [({}, inference["instances"])]
+    yield "pdhelp_inference_busy", "gauge", "Model instances generating.", [({}, inference["busy"])]
+    yield "pdhelp_inference_queue_depth", "gauge", "Requests waiting for a model instance.", [({}, inference["waiting"])]
+
+    ingestion = ingestion_queue.stats()
+    yield "pdhelp_ingestion_jobs", "gauge", "Ingestion jobs by state.", [
+        ({"state": "queued"}, ingestion["queued"]),
+        ({"state": "running"}, ingestion["running"]),
+    ]
+
+    batches = rag_engine.retrieval_batcher.stats()
+    yield "pdhelp_retrieval_batches_total", "counter", "Retrieval batches run.", [({}, batches["batches"])]
+    yield "pdhelp_retrieval_batch_items_total", "counter", "Questions retrieved in batches.", [({}, batches["items"])]
+
+    cache = rag_engine.answer_cache.stats()
+    yield "pdhelp_answer_cache_entries", "gauge", "Cached answers.", [({}, cache["size"])]
+    yield "pdhelp_answer_cache_lookups_total", "counter", "Answer cache lookups by result.", [
+        ({"result": "hit"}, cache["hits"]),
+        ({"result": "miss"}, cache["misses"]),
+    ]
+    yield "pdhelp_answer_cache_hit_ratio", "gauge", "Share of answer cache lookups that hit.", [({}, cache["hit_rate"])]
+
+    embeddings = rag_engine._embeddings_tool
+    if isinstance(embeddings, CachedEmbeddings):
+        stats = embeddings.stats()
+        lookups = stats["hits"] + stats["misses"]
+        yield "pdhelp_embedding_cache_lookups_total", "counter", "Embedding cache lookups by result.", [
+            ({"result": "hit"}, stats["hits"]),
+            ({"result": "miss"}, stats["misses"]),
+        ]
+        yield "pdhelp_embedding_cache_hit_ratio", "gauge", "Share of embedding cache lookups that hit.", [
+            ({}, stats["hits"] / lookups if lookups else 0.0)
+        ]
+
+    yield "pdhelp_component_ready", "gauge", "Whether each component has loaded.", [
+        ({"component": name}, int(status.state == "ready")) for name, status in rag_engine.components.items()
+    ]
+
+
+metrics.register_collector(_runtime_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("x-admin-token") or request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="admin token required.")
+
+
+@app.post("/debug/profile", response_class=PlainTextResponse)
+async def profile(
+    request: Request,
+    seconds: float = Query(default=10.0, gt=0, le=profiling.PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(default=profiling.PROFILE_INTERVAL_MS, ge=1, le=1000),
+    include_idle: bool = False,
+):
+    _require_admin(request)
+    if not profiling.profiler.start(interval_ms, include_idle):
+        raise HTTPException(status_code=409, detail="a profiling session is already running.")
+    # samples every thread, so live requests in the threadpool and workers show up
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        samples = await run_in_threadpool(profiling.profiler.stop)
+    return PlainTextResponse(
+        profiling.collapse(samples),
+        headers={"X-Profile-Seconds": str(seconds), "X-Profile-Ticks": str(profiling.profiler.ticks)},
+    )
 
 
 @app.get("/health")
@@ -91,6 +434,15 @@ def health_check():
     }
 
 
+@app.get("/ready")
+def readiness_check():
+    ready = rag_engine.is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "components": rag_engine.readiness()},
+    )
+
+
 @app.get("/")
 def serve_frontend():
     return FileResponse("app/static/index.html")
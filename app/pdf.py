@@ -0,0 +1,132 @@
+import itertools
+import math
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterator, List, Optional, Tuple
+
+PARSE_WORKERS = int(os.getenv("PDHELP_PARSE_WORKERS", str(os.cpu_count() or 1)))
+MIN_PAGES_PER_WORKER = int(os.getenv("PDHELP_MIN_PAGES_PER_WORKER", "25"))
+# long documents become more ranges than the pool keeps in flight, so only
+# a few ranges of text are held at once however long the document is
+MAX_PAGES_PER_RANGE = int(os.getenv("PDHELP_MAX_PAGES_PER_RANGE", "50"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _open(file_path: str):
+    from pypdf import PdfReader
+
+    reader = PdfReader(file_path)
+    if reader.is_encrypted:
+        reader.decrypt("")
+    return reader
+
+
+def _extract_page_text(page) -> str:
+    try:
+        return page.extract_text() or ""
+    except Exception:
+        pass
+    # some pages only break the default extractor, so retry just that page
+    try:
+        return page.extract_text(extraction_mode="layout") or ""
+    except Exception:
+        return ""
+
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    reader = _open(file_path)
+    return [(number, _extract_page_text(reader.pages[number])) for number in range(start, stop)]
+
+
+def page_ranges(
+    page_count: int, workers: int, min_pages: int, max_pages: int = MAX_PAGES_PER_RANGE
+) -> List[Tuple[int, int]]:
+    size = max(min(max(min_pages, math.ceil(page_count / max(workers, 1))), max_pages), 1)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork: ingestion runs on worker threads
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        # another document may have replaced it already
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _extract_in_pool(file_path: str, ranges: List[Tuple[int, int]], workers: int) -> Iterator[List[Tuple[int, str]]]:
+    done = 0
+    for attempt in range(2):
+        pool = _get_pool(workers)
+        try:
+            for pages in _collect_ranges(pool, file_path, ranges[done:], workers):
+                done += 1
+                yield pages
+            return
+        except BrokenProcessPool:
+            # a worker died, e.g. killed for memory, and the executor refuses
+            # all work from then on, so the next document would fail too
+            _discard_pool(pool)
+            if attempt:
+                raise
+            print(f"parse worker died, retrying {file_path} from page {ranges[done][0]} in a new pool")
+
+
+def _collect_ranges(
+    pool: ProcessPoolExecutor, file_path: str, ranges: List[Tuple[int, int]], workers: int
+) -> Iterator[List[Tuple[int, str]]]:
+    remaining = iter(ranges)
+    # a small window of ranges in flight keeps every worker busy without
+    # holding the text of the whole document in memory at once
+    pending = deque(
+        pool.submit(_extract_page_range, file_path, start, stop)
+        for start, stop in itertools.islice(remaining, workers * 2)
+    )
+    while pending:
+        # collecting in submission order keeps pages in document order
+        pages = pending.popleft().result()
+        for start, stop in itertools.islice(remaining, 1):
+            pending.append(pool.submit(_extract_page_range, file_path, start, stop))
+        yield pages
+
+
+def extract_pages(
+    file_path: str,
+    workers: int = PARSE_WORKERS,
+    on_pages: Optional[Callable[[int], None]] = None,
+) -> Iterator[Tuple[int, str]]:
+    page_count = len(_open(file_path).pages)
+    ranges = page_ranges(page_count, workers, MIN_PAGES_PER_WORKER, MAX_PAGES_PER_RANGE)
+
+    if len(ranges) <= 1 or workers <= 1:
+        results = (_extract_page_range(file_path, start, stop) for start, stop in ranges)
+    else:
+        results = _extract_in_pool(file_path, ranges, workers)
+
+    for pages in results:
+        if on_pages:
+            on_pages(len(pages))
+        yield from pages
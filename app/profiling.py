@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+PROFILE_INTERVAL_MS = float(os.getenv("PDHELP_PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = float(os.getenv("PDHELP_PROFILE_MAX_SECONDS", "120"))
+# python-level leaves of threads parked on a lock, queue or socket
+IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("batching.py", "_collect"),
+}
+THREAD_NUMBER = re.compile(r"[-_ ]?\d+$")
+
+
+def _frame_label(code) -> str:
+    # function level, not line level, so one function is one flamegraph box
+    filename = code.co_filename
+    marker = f"{os.sep}app{os.sep}"
+    if marker in filename:
+        filename = "app/" + filename.rsplit(marker, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.samples: Counter = Counter()
+        self.ticks = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: float = PROFILE_INTERVAL_MS, include_idle: bool = False) -> bool:
+        # nothing is hooked into the interpreter; between sessions there is no cost at all
+        with self._lock:
+            if self.running:
+                return False
+            self.samples = Counter()
+            self.ticks = 0
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval_ms / 1000, include_idle), name="profiler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def stop(self) -> Dict[str, int]:
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+        return dict(self.samples)
+
+    def _run(self, interval: float, include_idle: bool):
+        own = threading.get_ident()
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                leaf = frame.f_code
+                if not include_idle and (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                # pool threads differ only by number, so they share a root
+                thread = THREAD_NUMBER.sub("", names.get(ident, "thread")) or "thread"
+                stack.append(f"thread {thread}".replace(";", ":"))
+                self.samples[";".join(reversed(stack))] += 1
+            self.ticks += 1
+            self._stop.wait(max(0.0, interval - (time.perf_counter() - started)))
+
+
+def collapse(samples: Dict[str, int]) -> str:
+    # brendan gregg's folded format, read by flamegraph.pl, speedscope and inferno
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(samples.items(), key=lambda item: -item[1]))
+
+
+profiler = SamplingProfiler()
@@ -1,75 +1,620 @@
+import hashlib
+import itertools
+import json
+import math
 import os
-from typing import List
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import requests
-from langchain.chains import RetrievalQA
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.llms import CTransformers
-from langchain_chroma import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+# chroma, the text splitter, the model wrappers and torch are imported where
+# they are first used, so the api answers health checks before they load
+from app import metrics, pdf
+from app.batching import MicroBatcher
+from app.cache import SemanticAnswerCache
+from app.catalog import DocumentCatalog
+from app.embeddings import CachedEmbeddings, DeferredEmbeddings, PooledEmbeddings
+from app.lexical import LexicalIndex
 
 MODEL_URL = "https://huggingface.co/TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF/resolve/main/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf"
 MODEL_PATH = "models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf"
+MODEL_SHA256 = os.getenv("PDHELP_MODEL_SHA256", "")
+MIN_MODEL_BYTES = 100 * 1024 * 1024
+DOWNLOAD_SEGMENTS = int(os.getenv("PDHELP_DOWNLOAD_SEGMENTS", "4"))
 EMBEDDING_NAME = "all-MiniLM-L6-v2"
 MEMORY_PATH = "data/chroma_db"
+LEXICAL_INDEX_PATH = os.getenv("PDHELP_LEXICAL_INDEX_PATH", "data/lexical_index.sqlite3")
+CATALOG_PATH = os.getenv("PDHELP_CATALOG_PATH", "data/documents.sqlite3")
+INGEST_BATCH_SIZE = int(os.getenv("PDHELP_INGEST_BATCH_SIZE", "64"))
+# deleted chunks keep costing disk and keyword search time until the
+# indexes are compacted, which runs in the background past this many
+COMPACTION_MIN_DELETES = int(os.getenv("PDHELP_COMPACTION_MIN_DELETES", "1000"))
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("PDHELP_EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_THREADS = int(os.getenv("PDHELP_EMBEDDING_THREADS", "0"))
+EMBEDDING_NORMALIZE = os.getenv("PDHELP_EMBEDDING_NORMALIZE", "false").lower() in ("1", "true", "yes")
+EMBEDDING_PROCESSES = int(os.getenv("PDHELP_EMBEDDING_PROCESSES", "0"))
+EMBEDDING_CACHE_PATH = os.getenv("PDHELP_EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite3")
+EMBEDDING_CACHE_SIZE = int(os.getenv("PDHELP_EMBEDDING_CACHE_SIZE", "200000"))
+
+RETRIEVAL_K = int(os.getenv("PDHELP_RETRIEVAL_K", "3"))
+HYBRID_RETRIEVAL = os.getenv("PDHELP_HYBRID_RETRIEVAL", "true").lower() in ("1", "true", "yes")
+# reciprocal rank fusion constant; larger values flatten the gap between ranks
+RRF_K = 60
+RETRIEVAL_BATCH_SIZE = int(os.getenv("PDHELP_RETRIEVAL_BATCH_SIZE", "16"))
+RETRIEVAL_BATCH_WAIT_MS = float(os.getenv("PDHELP_RETRIEVAL_BATCH_WAIT_MS", "5"))
+GENERATION_DEFAULTS = {"max_new_tokens": int(os.getenv("PDHELP_MAX_NEW_TOKENS", "256")), "temperature": 0.5}
+CONTEXT_LENGTH = int(os.getenv("PDHELP_CONTEXT_LENGTH", "2048"))
+# upper bound on retrieved text in the prompt; the window left over after the
+# template, question and answer budget can make it smaller still
+CONTEXT_TOKEN_BUDGET = int(os.getenv("PDHELP_CONTEXT_TOKEN_BUDGET", "1024"))
+# rough size of a token for when no tokenizer is loaded
+CHARS_PER_TOKEN = 4
+MIN_TRIMMED_TOKENS = 32
+SNIPPET_LENGTH = 200
+
+# same wording as the RetrievalQA "stuff" chain the engine used to build per query
+QA_PROMPT = """Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+{context}
+
+Question: {question}
+Helpful Answer:"""
+
+LLM_INSTANCES = int(os.getenv("PDHELP_LLM_INSTANCES", "1"))
+LLM_QUEUE_SIZE = int(os.getenv("PDHELP_LLM_QUEUE_SIZE", "8"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("PDHELP_LLM_REQUEST_TIMEOUT", "120"))
+# cgroup v2, then v1: the memory limit and current usage of this container
+CGROUP_MEMORY_FILES = (
+    ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+    ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),
+)
+# share of currently available memory extra model instances may take
+LLM_MEMORY_FRACTION = 0.8
+# kv cache and scratch buffers on top of the weights, per instance
+LLM_INSTANCE_OVERHEAD = 256 * 1024 * 1024
+
+# ctransformers, or llama_cpp once llama-cpp-python is installed
+LLM_BACKEND = os.getenv("PDHELP_LLM_BACKEND", "ctransformers")
+# 0 leaves the value to the backend, except that several instances split the cores
+LLM_THREADS = int(os.getenv("PDHELP_LLM_THREADS", "0"))
+LLM_BATCH_SIZE = int(os.getenv("PDHELP_LLM_BATCH_SIZE", "0"))
+LLM_MMAP = os.getenv("PDHELP_LLM_MMAP", "true").lower() in ("1", "true", "yes")
+LLM_MLOCK = os.getenv("PDHELP_LLM_MLOCK", "false").lower() in ("1", "true", "yes")
+
+# everything before the context is the same in every prompt
+PROMPT_PREFIX = QA_PROMPT[: QA_PROMPT.index("{context}")]
+PREFIX_CACHE = os.getenv("PDHELP_PREFIX_CACHE", "true").lower() in ("1", "true", "yes")
+
+# chroma metadata values must be scalars, so each tag is stored as its own
+# boolean key that a `where` clause can match on
+TAG_KEY_PREFIX = "tag_"
+
+COMPONENTS = ("embeddings", "vector_store", "llm")
+
+QUERY_SECONDS = metrics.histogram("pdhelp_query_seconds", "Time to answer a question.", ("mode", "outcome"))
+QUERY_STAGE_SECONDS = metrics.histogram(
+    "pdhelp_query_stage_seconds", "Time a question spends in retrieval, prompt, queue and generation.", ("stage",)
+)
+RETRIEVAL_STAGE_SECONDS = metrics.histogram(
+    "pdhelp_retrieval_stage_seconds", "Time a retrieval batch spends embedding and searching.", ("stage",)
+)
+GENERATION_STAGE_SECONDS = metrics.histogram(
+    "pdhelp_generation_stage_seconds", "Time to the first token (prompt_eval) and for the rest (decode).", ("stage",)
+)
+GENERATION_TOKENS_PER_SECOND = metrics.histogram(
+    "pdhelp_generation_tokens_per_second",
+    "Decode speed per answer.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+GENERATED_TOKENS = metrics.counter("pdhelp_generated_tokens_total", "Tokens generated.")
+INGEST_STAGE_SECONDS = metrics.histogram(
+    "pdhelp_ingest_stage_seconds", "Time an ingestion batch spends parsing, embedding and storing.", ("stage",)
+)
+INGESTED_CHUNKS = metrics.counter("pdhelp_ingested_chunks_total", "Chunks written to the vector store.")
+
+ProgressCallback = Callable[[str, int], None]
+
+
+def normalize_tags(tags: Optional[Iterable[str]]) -> List[str]:
+    return list(dict.fromkeys(tag.strip().lower() for tag in tags or [] if tag.strip()))
+
+
+def tag_metadata(tags: Optional[Iterable[str]]) -> Dict:
+    tags = normalize_tags(tags)
+    if not tags:
+        return {}
+    return {"tags": ",".join(tags), **{TAG_KEY_PREFIX + tag: True for tag in tags}}
+
+
+def document_filter(doc_ids: Optional[List[str]] = None, tags: Optional[List[str]] = None) -> Optional[Dict]:
+    clauses = []
+    doc_ids = list(dict.fromkeys(doc_ids or []))
+    if doc_ids:
+        clauses.append({"doc_id": doc_ids[0]} if len(doc_ids) == 1 else {"doc_id": {"$in": doc_ids}})
+    # a chunk matches when it carries any of the requested tags
+    tag_clauses = [{TAG_KEY_PREFIX + tag: True} for tag in normalize_tags(tags)]
+    if tag_clauses:
+        clauses.append(tag_clauses[0] if len(tag_clauses) == 1 else {"$or": tag_clauses})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class ComponentStatus:
+    def __init__(self):
+        self.state = "pending"
+        self.seconds: Optional[float] = None
+        self.error: Optional[Exception] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "state": self.state,
+            "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+            "error": str(self.error) if self.error is not None else None,
+        }
+
+
+class LLMBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def load(self, settings: Dict):
+        ...
+
+    @abstractmethod
+    def stream(self, llm, prompt: str, **params) -> Iterator[str]:
+        ...
+
+    @abstractmethod
+    def tokenize(self, llm, text: str) -> List[int]:
+        ...
+
+    @abstractmethod
+    def prime(self, llm, prefix: str):
+        ...
+
+
+class CTransformersBackend(LLMBackend):
+    name = "ctransformers"
+
+    def load(self, settings: Dict):
+        from langchain_community.llms import CTransformers
+
+        config = {
+            **GENERATION_DEFAULTS,
+            "context_length": settings["context_length"],
+            "mmap": settings["mmap"],
+            "mlock": settings["mlock"],
+        }
+        if settings["threads"]:
+            config["threads"] = settings["threads"]
+        if settings["batch_size"]:
+            config["batch_size"] = settings["batch_size"]
+        return CTransformers(model=MODEL_PATH, model_type="llama", config=config)
+
+    def stream(self, llm, prompt: str, **params) -> Iterator[str]:
+        # the langchain wrapper ignores call-time generation settings and only
+        # returns the finished text, so drive the ctransformers model it holds
+        return llm.client(prompt, stream=True, **params)
+
+    def tokenize(self, llm, text: str) -> List[int]:
+        return llm.client.tokenize(text)
+
+    def prime(self, llm, prefix: str):
+        client = llm.client
+        client.eval(client.prepare_inputs_for_generation(client.tokenize(prefix)))
+
+
+class LlamaCppBackend(LLMBackend):
+    name = "llama_cpp"
+
+    def load(self, settings: Dict):
+        try:
+            from llama_cpp import Llama
+        except ImportError as e:
+            # optional, and not in requirements.txt since it builds llama.cpp on install
+            raise RuntimeError(
+                "PDHELP_LLM_BACKEND=llama_cpp needs the llama-cpp-python package: pip install llama-cpp-python"
+            ) from e
+
+        kwargs = {
+            "model_path": MODEL_PATH,
+            "n_ctx": settings["context_length"],
+            "use_mmap": settings["mmap"],
+            "use_mlock": settings["mlock"],
+            "verbose": False,
+        }
+        if settings["threads"]:
+            kwargs["n_threads"] = settings["threads"]
+            kwargs["n_threads_batch"] = settings["threads"]
+        if settings["batch_size"]:
+            kwargs["n_batch"] = settings["batch_size"]
+        return Llama(**kwargs)
+
+    def stream(self, llm, prompt: str, max_new_tokens: Optional[int] = None, temperature: Optional[float] = None):
+        chunks = llm.create_completion(
+            prompt,
+            stream=True,
+            max_tokens=max_new_tokens or GENERATION_DEFAULTS["max_new_tokens"],
+            temperature=GENERATION_DEFAULTS["temperature"] if temperature is None else temperature,
+        )
+        for chunk in chunks:
+            yield chunk["choices"][0]["text"]
+
+    def tokenize(self, llm, text: str) -> List[int]:
+        return llm.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def prime(self, llm, prefix: str):
+        # a one-token completion tokenizes the prefix exactly as a real prompt
+        # would, and llama.cpp keeps the matching kv cache for the next call
+        llm.create_completion(prefix, max_tokens=1)
+
+
+BACKENDS = {backend.name: backend for backend in (CTransformersBackend, LlamaCppBackend)}
+
+
+class InferenceError(Exception):
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InferenceQueueFullError(InferenceError):
+    pass
+
+
+class InferenceTimeoutError(InferenceError):
+    pass
+
+
+class InferenceCancelledError(InferenceError):
+    pass
+
+
+class _Waiter:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.instance = None
+
+
+class InferenceScheduler:
+    def __init__(self, queue_size: int = LLM_QUEUE_SIZE):
+        self._queue_size = queue_size
+        self._instances: List = []
+        self._idle = deque()
+        self._waiting = deque()
+        self._lock = threading.Lock()
+        self._average_seconds = 5.0
+
+    def reset(self, instances: List):
+        with self._lock:
+            self._instances = list(instances)
+            self._idle = deque(self._instances)
+
+    def add_instance(self, instance):
+        with self._lock:
+            self._instances.append(instance)
+        self._release(instance)
+
+    @contextmanager
+    def acquire(self, deadline: float, cancel: Optional[threading.Event] = None):
+        instance = self._wait_for_instance(deadline, cancel)
+        started = time.monotonic()
+        try:
+            yield instance
+        finally:
+            with self._lock:
+                self._average_seconds = 0.8 * self._average_seconds + 0.2 * (time.monotonic() - started)
+            self._release(instance)
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "instances": len(self._instances),
+                "busy": len(self._instances) - len(self._idle),
+                "waiting": len(self._waiting),
+                "queue_size": self._queue_size,
+            }
+
+    def _retry_after(self) -> int:
+        # roughly how long until the queue ahead of a new request has drained
+        rounds = (len(self._waiting) + 1) / max(len(self._instances), 1)
+        return max(1, math.ceil(rounds * self._average_seconds))
+
+    def _wait_for_instance(self, deadline: float, cancel: Optional[threading.Event]):
+        with self._lock:
+            if self._idle and not self._waiting:
+                return self._idle.popleft()
+            if len(self._waiting) >= self._queue_size:
+                raise InferenceQueueFullError("inference queue is full. try again later.", self._retry_after())
+            waiter = _Waiter()
+            self._waiting.append(waiter)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            # wake up regularly so a disconnected client does not hold its place in line
+            waiter.ready.wait(min(max(remaining, 0), 0.25))
+            with self._lock:
+                if waiter.instance is not None:
+                    return waiter.instance
+                if cancel is not None and cancel.is_set():
+                    self._waiting.remove(waiter)
+                    raise InferenceCancelledError("request cancelled while queued.")
+                if time.monotonic() >= deadline:
+                    self._waiting.remove(waiter)
+                    raise InferenceTimeoutError("timed out waiting for a free model instance.", self._retry_after())
+
+    def _release(self, instance):
+        with self._lock:
+            if instance not in self._instances:
+                return
+            if self._waiting:
+                # hand the instance straight to the oldest waiter so the queue stays fifo
+                waiter = self._waiting.popleft()
+                waiter.instance = instance
+                waiter.ready.set()
+            else:
+                self._idle.append(instance)
 
 
 class RagEngine:
     def __init__(self):
         self.vector_store = None
+        self.lexical_index: Optional[LexicalIndex] = None
+        self.catalog: Optional[DocumentCatalog] = None
+        self.inference = InferenceScheduler()
+        self.backend: LLMBackend = CTransformersBackend()
         self.llm = None
         self._embeddings_tool = None
+        self.index_version = 0
+        self._indexed_files: Dict[str, Dict] = {}
+        self.answer_cache = SemanticAnswerCache()
+        self.retrieval_batcher = MicroBatcher(
+            self._lookup_batch, RETRIEVAL_BATCH_SIZE, RETRIEVAL_BATCH_WAIT_MS / 1000, name="retrieval-batcher"
+        )
+        self.components = {name: ComponentStatus() for name in COMPONENTS}
+        self._store_embeddings = DeferredEmbeddings()
+        self._loaders: List[threading.Thread] = []
+        self._load_lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        self._compaction_lock = threading.Lock()
+        self.deleted_since_compaction = 0
+        self.compactions = 0
+        self.last_compaction: Optional[Dict] = None
 
-    def initialize(self):
-        try:
-            self._download_model_if_needed()
+    @property
+    def llm(self):
+        return self._llm
 
-            print(f"loading embedding tool: {EMBEDDING_NAME}")
-            try:
-                self._embeddings_tool = HuggingFaceEmbeddings(model_name=EMBEDDING_NAME)
-            except Exception as e:
-                print(f"error loading embeddings: {e}")
-                raise
+    @llm.setter
+    def llm(self, llm):
+        # the primary instance is what readiness checks look at; the
+        # scheduler hands out it and any extra instances to requests
+        self._llm = llm
+        self.inference.reset([llm] if llm is not None else [])
 
-            print(f"connecting to vector store at {MEMORY_PATH}")
-            try:
-                self.vector_store = Chroma(
-                    persist_directory=MEMORY_PATH,
-                    embedding_function=self._embeddings_tool,
+    def initialize(self, *names: str):
+        names = names or COMPONENTS
+        self.start_loading(*names)
+        self.wait_until_loaded()
+
+        failed = [name for name in names if self.components[name].state == "failed"]
+        if failed:
+            errors = "; ".join(f"{name}: {self.components[name].error}" for name in failed)
+            print(f"rag engine failed to initialize: {errors}")
+            raise self.components[failed[0]].error
+
+        print("rag engine initialized successfully")
+
+    def start_loading(self, *names: str):
+        # the three heavy components load side by side; chroma gets a deferred
+        # embedding function so it can open before the transformer is ready.
+        # offline jobs that never generate can leave the llm out
+        with self._load_lock:
+            if self._loaders:
+                return
+            loaders = {
+                "embeddings": self._load_embeddings_component,
+                "vector_store": self._load_vector_store,
+                "llm": self._load_llm,
+            }
+            for name in names or COMPONENTS:
+                thread = threading.Thread(
+                    target=self._run_loader, args=(name, loaders[name]), name=f"load-{name}", daemon=True
                 )
-            except Exception as e:
-                print(f"error connecting to vector store: {e}")
-                self.vector_store = None
-                raise
+                self._loaders.append(thread)
+                thread.start()
+
+    def wait_until_loaded(self, timeout: Optional[float] = None):
+        for thread in self._loaders:
+            thread.join(timeout)
+
+    def is_ready(self, *names: str) -> bool:
+        return all(self.components[name].state == "ready" for name in (names or COMPONENTS))
+
+    def readiness(self) -> Dict:
+        return {name: status.to_dict() for name, status in self.components.items()}
+
+    def _run_loader(self, name: str, loader: Callable[[], None]):
+        status = self.components[name]
+        status.state = "loading"
+        started = time.perf_counter()
+        try:
+            loader()
+        except Exception as e:
+            status.error = e
+            status.state = "failed"
+        else:
+            status.state = "ready"
+        finally:
+            status.seconds = time.perf_counter() - started
+
+    def _load_embeddings_component(self):
+        print(f"loading embedding tool: {EMBEDDING_NAME}")
+        try:
+            self._embeddings_tool = self._load_embeddings()
+        except Exception as e:
+            print(f"error loading embeddings: {e}")
+            self._store_embeddings.fail(e)
+            raise
+        self._store_embeddings.resolve(self._embeddings_tool)
+
+    def _load_vector_store(self):
+        print(f"connecting to vector store at {MEMORY_PATH}")
+        try:
+            from langchain_chroma import Chroma
+
+            self.vector_store = Chroma(
+                persist_directory=MEMORY_PATH,
+                embedding_function=self._store_embeddings,
+            )
+        except Exception as e:
+            print(f"error connecting to vector store: {e}")
+            self.vector_store = None
+            raise
+
+        self.catalog = DocumentCatalog(CATALOG_PATH)
+        self._backfill_catalog()
+        if HYBRID_RETRIEVAL:
+            self.lexical_index = LexicalIndex(LEXICAL_INDEX_PATH)
+            self._backfill_lexical_index()
+
+    def _backfill_catalog(self):
+        # stores created before the catalog are counted once, not on every listing
+        if self.catalog.size() > 0:
+            return
+        page_size = INGEST_BATCH_SIZE * 16
+        offset = 0
+        while True:
+            page = self.vector_store.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+            if len(page["ids"]) == 0:
+                break
+            if offset == 0:
+                print("building document catalog for existing documents")
+            self.catalog.add(page["documents"], [metadata or {} for metadata in page["metadatas"]])
+            offset += len(page["ids"])
+            if len(page["ids"]) < page_size:
+                break
+
+    def _backfill_lexical_index(self):
+        # stores created before hybrid retrieval get their keyword index once
+        if self.lexical_index.size() > 0:
+            return
+        page_size = INGEST_BATCH_SIZE * 16
+        offset = 0
+        while True:
+            page = self.vector_store.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+            if len(page["ids"]) == 0:
+                break
+            if offset == 0:
+                print("building keyword index for existing documents")
+            self.lexical_index.add(page["ids"], page["documents"], [metadata or {} for metadata in page["metadatas"]])
+            offset += len(page["ids"])
+            if len(page["ids"]) < page_size:
+                break
+
+    def _load_llm(self):
+        if LLM_BACKEND not in BACKENDS:
+            raise ValueError(f"unknown llm backend {LLM_BACKEND!r}. choose one of: {', '.join(BACKENDS)}")
+        self.backend = BACKENDS[LLM_BACKEND]()
+        self._download_model_if_needed()
 
-            print(f"loading llm from {MODEL_PATH}")
+        instances = self._llm_instance_budget()
+        settings = self._backend_settings(instances)
+
+        print(f"loading llm from {MODEL_PATH} with {self.backend.name}")
+        try:
+            self.llm = self._new_llm(settings)
+        except Exception as e:
+            print(f"error loading llm: {e}")
+            self.llm = None
+            raise
+
+        for number in range(1, instances):
             try:
-                self.llm = CTransformers(
-                    model=MODEL_PATH,
-                    model_type="llama",
-                    config={"max_new_tokens": 256, "temperature": 0.5, "context_length": 2048},
-                )
+                self.inference.add_instance(self._new_llm(settings))
             except Exception as e:
-                print(f"error loading llm: {e}")
-                self.llm = None
-                raise
+                print(f"error loading llm instance {number + 1}: {e}. continuing with {number}")
+                break
 
-            if self.vector_store is not None and self.llm is not None:
-                print("rag engine launched successfully")
-            else:
-                print("rag engine launched but components are missing")
+    def _backend_settings(self, instances: int) -> Dict:
+        threads = LLM_THREADS
+        if not threads and instances > 1:
+            # instances share the cores instead of each claiming all of them
+            threads = max(1, (os.cpu_count() or 1) // instances)
+        return {
+            "context_length": CONTEXT_LENGTH,
+            "threads": threads,
+            "batch_size": LLM_BATCH_SIZE,
+            "mmap": LLM_MMAP,
+            "mlock": LLM_MLOCK,
+        }
+
+    def _new_llm(self, settings: Dict):
+        llm = self.backend.load(settings)
+        if PREFIX_CACHE:
+            self._prime_prompt_prefix(llm)
+        return llm
 
+    def _prime_prompt_prefix(self, llm):
+        # both backends only evaluate the part of a prompt that differs from
+        # what the model already holds, so with the static preamble evaluated
+        # up front every request, the first one included, starts at its context
+        try:
+            self.backend.prime(llm, PROMPT_PREFIX)
         except Exception as e:
-            print(f"rag engine failed to initialize: {e}")
-            raise
+            print(f"could not prime the prompt prefix: {e}")
+
+    def _llm_instance_budget(self) -> int:
+        requested = max(1, LLM_INSTANCES)
+        available = _available_memory()
+        if requested == 1 or available is None:
+            return requested
+        per_instance = os.path.getsize(MODEL_PATH) + LLM_INSTANCE_OVERHEAD
+        affordable = max(1, int(available * LLM_MEMORY_FRACTION // per_instance))
+        if affordable < requested:
+            print(f"only enough memory for {affordable} of {requested} llm instances")
+        return min(requested, affordable)
+
+    def _load_embeddings(self):
+        if EMBEDDING_THREADS > 0:
+            import torch
+
+            torch.set_num_threads(EMBEDDING_THREADS)
+
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        embeddings = HuggingFaceEmbeddings(
+            model_name=EMBEDDING_NAME,
+            encode_kwargs={"batch_size": EMBEDDING_BATCH_SIZE, "normalize_embeddings": EMBEDDING_NORMALIZE},
+        )
+        if EMBEDDING_PROCESSES > 1:
+            print(f"starting embedding encode pool with {EMBEDDING_PROCESSES} processes")
+            embeddings = PooledEmbeddings(embeddings.client, EMBEDDING_PROCESSES, EMBEDDING_BATCH_SIZE, EMBEDDING_NORMALIZE)
+        if EMBEDDING_CACHE_SIZE > 0:
+            # normalisation changes the vectors, so it is part of the cache key
+            cache_model = f"{EMBEDDING_NAME}:normalize={EMBEDDING_NORMALIZE}"
+            embeddings = CachedEmbeddings(embeddings, cache_model, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE)
+        return embeddings
 
     def _download_model_if_needed(self):
-        if not os.path.exists("models"):
-            os.makedirs("models", exist_ok=True)
+        models_dir = os.path.dirname(MODEL_PATH)
+        if models_dir:
+            os.makedirs(models_dir, exist_ok=True)
 
         if os.path.exists(MODEL_PATH):
-            if os.path.getsize(MODEL_PATH) < 100 * 1024 * 1024:
+            if os.path.getsize(MODEL_PATH) < MIN_MODEL_BYTES:
                 print(f"model file found but too small ({os.path.getsize(MODEL_PATH)} bytes). redownloading...")
                 os.remove(MODEL_PATH)
             else:
@@ -77,77 +622,627 @@ class RagEngine:
                 return
 
         print(f"model not found locally. downloading from {MODEL_URL}...")
-        temp_model_path = MODEL_PATH + ".part"
+        if not MODEL_SHA256:
+            print("PDHELP_MODEL_SHA256 is not set, skipping checksum verification")
         try:
-            response = requests.get(MODEL_URL, stream=True, timeout=60)
-            if response.status_code == 200:
-                with open(temp_model_path, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                os.rename(temp_model_path, MODEL_PATH)
-                print("model downloaded successfully")
-            else:
-                raise Exception(f"failed to download model. status: {response.status_code}")
+            from app import download
+
+            download.download_file(
+                MODEL_URL,
+                MODEL_PATH,
+                segments=DOWNLOAD_SEGMENTS,
+                expected_sha256=MODEL_SHA256 or None,
+            )
+            print("model downloaded successfully")
         except Exception as e:
+            # a partial .part file is kept on purpose so the next start resumes it
             print(f"error downloading model: {e}")
-            if os.path.exists(temp_model_path):
-                os.remove(temp_model_path)
             raise
 
-    def process_document(self, file_path: str) -> List:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=700, chunk_overlap=80)
+    def process_document(
+        self,
+        file_path: str,
+        on_progress: Optional[ProgressCallback] = None,
+        metadata: Optional[Dict] = None,
+    ) -> List:
+        with INGEST_STAGE_SECONDS.time(stage="parse"):
+            return list(self.iter_chunks(file_path, on_progress, metadata))
 
-        raw_pages = PyPDFLoader(file_path).load()
-        text_pages = [page for page in raw_pages if getattr(page, "page_content", "").strip()]
-        if text_pages:
-            chunks = splitter.split_documents(text_pages)
-            chunks = [chunk for chunk in chunks if getattr(chunk, "page_content", "").strip()]
-            if chunks:
-                return chunks
+    def ingest_document(
+        self,
+        file_path: str,
+        on_progress: Optional[ProgressCallback] = None,
+        metadata: Optional[Dict] = None,
+    ) -> int:
+        if self.vector_store is None:
+            raise RuntimeError("rag engine not initialized")
+        return self.add_documents(self.iter_chunks(file_path, on_progress, metadata), on_progress)
+
+    def iter_chunks(
+        self,
+        file_path: str,
+        on_progress: Optional[ProgressCallback] = None,
+        metadata: Optional[Dict] = None,
+    ) -> Iterator[Document]:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-        fallback_text = self._extract_text_with_pypdf(file_path)
-        if not fallback_text.strip():
-            return []
+        splitter = RecursiveCharacterTextSplitter(chunk_size=700, chunk_overlap=80)
+        on_pages = (lambda count: on_progress("pages_parsed", count)) if on_progress else None
+
+        for number, text in pdf.extract_pages(file_path, on_pages=on_pages):
+            if not text.strip():
+                continue
+            page = Document(page_content=text, metadata={"source": file_path, "page": number, **(metadata or {})})
+            for chunk in splitter.split_documents([page]):
+                if getattr(chunk, "page_content", "").strip():
+                    yield chunk
 
-        return splitter.create_documents([fallback_text])
+    def add_documents(self, documents: Iterable, on_progress: Optional[ProgressCallback] = None) -> int:
+        if self.vector_store is None:
+            raise RuntimeError("rag engine not initialized")
 
-    def _extract_text_with_pypdf(self, file_path: str) -> str:
+        # chunks handed over as a list were parsed already
+        lazy = not isinstance(documents, (list, tuple))
+        documents = iter(documents)
+        total = 0
+        written = 0
+        seen_ids = set()
         try:
-            from pypdf import PdfReader
+            # pull one batch at a time so a lazy source is never fully materialised
+            while True:
+                started = time.perf_counter()
+                batch = list(itertools.islice(documents, INGEST_BATCH_SIZE))
+                if lazy:
+                    INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, stage="parse")
+                if not batch:
+                    break
+                total += len(batch)
+                if on_progress:
+                    on_progress("chunks_total", len(batch))
 
-            reader = PdfReader(file_path)
-            if reader.is_encrypted:
-                reader.decrypt("")
+                unique_docs, ids = [], []
+                for doc in batch:
+                    chunk_id = self.chunk_id(
+                        doc.page_content, doc.metadata.get("doc_id"), doc.metadata.get("revision")
+                    )
+                    # chroma rejects repeated ids within one upsert
+                    if chunk_id not in seen_ids:
+                        seen_ids.add(chunk_id)
+                        unique_docs.append(doc)
+                        ids.append(chunk_id)
 
-            page_text = []
-            for page in reader.pages:
-                page_text.append(page.extract_text() or "")
-            return "\n".join(page_text)
-        except Exception:
-            return ""
+                # ids derived from document, revision and content make chroma upsert instead of
+                # appending duplicates; it embeds and writes a batch in the same call
+                if unique_docs:
+                    with INGEST_STAGE_SECONDS.time(stage="embed_and_store"):
+                        self.vector_store.add_documents(unique_docs, ids=ids)
+                    if self.lexical_index is not None:
+                        with INGEST_STAGE_SECONDS.time(stage="keyword_index"):
+                            self.lexical_index.add(
+                                ids, [doc.page_content for doc in unique_docs], [doc.metadata for doc in unique_docs]
+                            )
+                    if self.catalog is not None:
+                        self.catalog.add([doc.page_content for doc in unique_docs], [doc.metadata for doc in unique_docs])
+                    written += len(unique_docs)
+                    INGESTED_CHUNKS.inc(len(unique_docs))
+                if on_progress:
+                    on_progress("chunks_embedded", len(batch))
+                    on_progress("chunks_persisted", len(batch))
+        finally:
+            if written:
+                self._mark_index_changed()
+        return total
 
-    def add_documents(self, documents: List):
+    @staticmethod
+    def chunk_id(text: str, doc_id: Optional[str] = None, revision: Optional[str] = None) -> str:
+        # the same passage in two documents needs two chunks, or filtering
+        # by document would lose it from one of them; a replacement must not
+        # overwrite the chunks of the revision it replaces until it has finished
+        key = f"{doc_id}\0{text}" if doc_id else text
+        if revision:
+            key = f"{revision}\0{key}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def find_document(self, file_sha256: str) -> Optional[Dict]:
         if self.vector_store is None:
+            return None
+        if file_sha256 in self._indexed_files:
+            return self._indexed_files[file_sha256]
+
+        existing = self.vector_store.get(where={"file_sha256": file_sha256}, limit=1, include=["metadatas"])
+        if len(existing["ids"]) == 0:
+            return None
+        metadata = (existing["metadatas"] or [None])[0] or {}
+        # stores from before document ids have no doc_id on their chunks
+        document = {"doc_id": metadata.get("doc_id"), "filename": metadata.get("filename")}
+        self._indexed_files[file_sha256] = document
+        return document
+
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        if self.vector_store is None:
+            return None
+        existing = self.vector_store.get(where={"doc_id": doc_id}, limit=1, include=["metadatas"])
+        if len(existing["ids"]) == 0:
+            return None
+        metadata = (existing["metadatas"] or [None])[0] or {}
+        return {
+            "doc_id": doc_id,
+            "filename": metadata.get("filename"),
+            "tags": [tag for tag in str(metadata.get("tags", "")).split(",") if tag],
+        }
+
+    def list_documents(self) -> List[Dict]:
+        if self.vector_store is None or self.catalog is None:
             raise RuntimeError("rag engine not initialized")
-        self.vector_store.add_documents(documents)
+        return self.catalog.documents()
 
-    def query(self, question: str) -> str:
-        if self.vector_store is None or self.llm is None:
+    def delete_document(self, doc_id: str) -> int:
+        removed = self._delete_chunks(doc_id, {"doc_id": doc_id})
+        if self.catalog is not None:
+            self.catalog.remove(doc_id)
+        return removed
+
+    def prune_document(self, doc_id: str, revision: str) -> int:
+        # a replacement upserts its chunks first and only then drops the ones
+        # it did not write, so the document never disappears from search
+        removed = self._delete_chunks(doc_id, {"$and": [{"doc_id": doc_id}, {"revision": {"$ne": revision}}]})
+        if self.catalog is not None:
+            self.catalog.remove(doc_id, keep=revision)
+        return removed
+
+    def delete_revision(self, doc_id: str, revision: str) -> int:
+        removed = self._delete_chunks(doc_id, {"$and": [{"doc_id": doc_id}, {"revision": revision}]})
+        if self.catalog is not None:
+            self.catalog.remove(doc_id, revision=revision)
+        return removed
+
+    def _delete_chunks(self, doc_id: str, where: Dict) -> int:
+        if self.vector_store is None:
             raise RuntimeError("rag engine not initialized")
+        ids = self.vector_store.get(where=where, include=[])["ids"]
+        if not ids:
+            return 0
+        batch_size = INGEST_BATCH_SIZE * 16
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start : start + batch_size]
+            self.vector_store.delete(ids=batch)
+            if self.lexical_index is not None:
+                self.lexical_index.delete(batch)
 
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": 3})
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=self.llm,
-            chain_type="stuff",
-            retriever=retriever,
-        )
+        self._indexed_files = {sha: doc for sha, doc in self._indexed_files.items() if doc["doc_id"] != doc_id}
+        self._mark_index_changed()
+        with self._compaction_lock:
+            self.deleted_since_compaction += len(ids)
+            due = self.deleted_since_compaction >= COMPACTION_MIN_DELETES
+        if due:
+            self.start_compaction()
+        return len(ids)
 
+    def start_compaction(self) -> bool:
+        with self._compaction_lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return False
+            self._compaction = threading.Thread(target=self._compact, name="compaction", daemon=True)
+            self._compaction.start()
+            return True
+
+    def compaction_status(self) -> Dict:
+        with self._compaction_lock:
+            return {
+                "running": self._compaction is not None and self._compaction.is_alive(),
+                "deleted_since_compaction": self.deleted_since_compaction,
+                "compactions": self.compactions,
+                "last": self.last_compaction,
+            }
+
+    def _compact(self):
+        with self._compaction_lock:
+            deleted = self.deleted_since_compaction
+        started = time.perf_counter()
+        errors = []
+        print(f"compacting indexes after {deleted} deleted chunks")
+        if self.lexical_index is not None:
+            try:
+                self.lexical_index.compact()
+            except Exception as e:
+                errors.append(f"keyword index: {e}")
         try:
-            result = qa_chain.invoke(question)
-            return result.get("result", "no answer found")
+            self._vacuum_vector_store()
         except Exception as e:
+            errors.append(f"vector store: {e}")
+        for error in errors:
+            print(f"error during compaction: {error}")
+
+        with self._compaction_lock:
+            self.deleted_since_compaction = max(0, self.deleted_since_compaction - deleted)
+            self.compactions += 1
+            self.last_compaction = {
+                "finished_at": time.time(),
+                "seconds": round(time.perf_counter() - started, 3),
+                "deleted_chunks": deleted,
+                "errors": errors,
+            }
+
+    def _vacuum_vector_store(self):
+        # chroma drops deleted rows from its sqlite file but never returns the
+        # pages to the filesystem; a busy store just waits for the next run
+        path = os.path.join(MEMORY_PATH, "chroma.sqlite3")
+        if not os.path.exists(path):
+            return
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            db.execute("VACUUM")
+        finally:
+            db.close()
+
+    def _mark_index_changed(self):
+        # cached answers may cite an outdated corpus once the collection changes
+        self.index_version += 1
+        self.answer_cache.clear()
+
+    def query(
+        self,
+        question: str,
+        k: Optional[int] = None,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+        doc_ids: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+        timings: Optional[Dict] = None,
+        timeout: Optional[float] = None,
+        raise_errors: bool = False,
+    ) -> str:
+        if self.vector_store is None or self.llm is None:
+            raise RuntimeError("rag engine not initialized")
+
+        deadline = _deadline(timeout)
+        where = document_filter(doc_ids, tags)
+        received = started = time.perf_counter()
+        try:
+            scope = self._cache_scope(k, max_new_tokens, temperature, where)
+            embedding, cached, docs = self._lookup(question, k, scope, where)
+            started = _record_stage(timings, "retrieval", started)
+            if cached is not None:
+                if timings is not None:
+                    timings["cached"] = True
+                _finish_query("query", "cached", received)
+                return cached["answer"]
+
+            prompt, docs = self._build_prompt(docs, question, max_new_tokens)
+            started = _record_stage(timings, "prompt", started)
+            with self.inference.acquire(deadline, cancel) as llm:
+                started = _record_stage(timings, "queue", started)
+                tokens = self._generate(
+                    llm, prompt, deadline, cancel, max_new_tokens=max_new_tokens, temperature=temperature
+                )
+                answer = "".join(tokens).strip()
+            _record_stage(timings, "generation", started)
+            _finish_query("query", "answered", received)
+            if not answer:
+                return "no answer found"
+
+            self.answer_cache.put(embedding, scope, {"answer": answer, "sources": self._describe_sources(docs)})
+            return answer
+        except InferenceError:
+            _finish_query("query", "error", received)
+            raise
+        except Exception as e:
+            _finish_query("query", "error", received)
             print(f"error during qa: {e}")
+            # offline callers record the failure instead of taking this reply as the answer
+            if raise_errors:
+                raise
             return "error processing request"
 
+    def stream_query(
+        self,
+        question: str,
+        k: Optional[int] = None,
+        max_new_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+        doc_ids: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+    ) -> Iterator[Dict]:
+        if self.vector_store is None or self.llm is None:
+            raise RuntimeError("rag engine not initialized")
+
+        deadline = _deadline(None)
+        where = document_filter(doc_ids, tags)
+        received = started = time.perf_counter()
+
+        try:
+            scope = self._cache_scope(k, max_new_tokens, temperature, where)
+            embedding, cached, docs = self._lookup(question, k, scope, where)
+            started = _record_stage(None, "retrieval", started)
+            if cached is not None:
+                _finish_query("stream", "cached", received)
+                yield {"event": "sources", "data": cached["sources"]}
+                yield {"event": "token", "data": cached["answer"]}
+                return
+
+            prompt, docs = self._build_prompt(docs, question, max_new_tokens)
+            sources = self._describe_sources(docs)
+            started = _record_stage(None, "prompt", started)
+            tokens = []
+            # queue for an instance before the first event, so a full queue is still a status code
+            with self.inference.acquire(deadline, cancel) as llm:
+                started = _record_stage(None, "queue", started)
+                yield {"event": "sources", "data": sources}
+                for token in self._generate(
+                    llm, prompt, deadline, cancel, max_new_tokens=max_new_tokens, temperature=temperature
+                ):
+                    tokens.append(token)
+                    yield {"event": "token", "data": token}
+            _record_stage(None, "generation", started)
+        except Exception:
+            _finish_query("stream", "error", received)
+            raise
+        _finish_query("stream", "answered", received)
+
+        answer = "".join(tokens).strip()
+        if answer:
+            self.answer_cache.put(embedding, scope, {"answer": answer, "sources": sources})
+
+    def _cache_scope(
+        self,
+        k: Optional[int],
+        max_new_tokens: Optional[int],
+        temperature: Optional[float],
+        where: Optional[Dict] = None,
+    ):
+        where_key = json.dumps(where, sort_keys=True) if where else None
+        return (self.index_version, k or RETRIEVAL_K, max_new_tokens, temperature, where_key)
+
+    def _lookup(
+        self, question: str, k: Optional[int], scope, where: Optional[Dict] = None
+    ) -> Tuple[List[float], Optional[Dict], Optional[List]]:
+        if RETRIEVAL_BATCH_WAIT_MS <= 0:
+            return self._lookup_batch([(question, k, where, scope)])[0]
+        return self.retrieval_batcher.submit((question, k, where, scope))
+
+    def _lookup_batch(self, requests: List[Tuple]) -> List[Tuple]:
+        # questions that arrive together share one embedding call and one vector search
+        started = time.perf_counter()
+        embeddings = self._embed_questions([question for question, _, _, _ in requests])
+        RETRIEVAL_STAGE_SECONDS.observe(time.perf_counter() - started, stage="embed")
+        cached = [self.answer_cache.get(embedding, scope) for embedding, (_, _, _, scope) in zip(embeddings, requests)]
+
+        misses = [i for i, hit in enumerate(cached) if hit is None]
+        if not misses:
+            return list(zip(embeddings, cached, [None] * len(requests)))
+        with RETRIEVAL_STAGE_SECONDS.time(stage="vector_search"):
+            found = self._retrieve_many(
+                [embeddings[i] for i in misses], [requests[i][1] for i in misses], [requests[i][2] for i in misses]
+            )
+        if self.lexical_index is not None:
+            with RETRIEVAL_STAGE_SECONDS.time(stage="keyword_search"):
+                found = [
+                    self._fuse(requests[i][0], requests[i][1], result, requests[i][2])
+                    for i, result in zip(misses, found)
+                ]
+        docs: List[Optional[List]] = [None] * len(requests)
+        for i, result in zip(misses, found):
+            docs[i] = result
+        return list(zip(embeddings, cached, docs))
+
+    def _embed_questions(self, questions: List[str]) -> List[List[float]]:
+        if len(questions) == 1:
+            return [self._embeddings_tool.embed_query(questions[0])]
+        if isinstance(self._embeddings_tool, CachedEmbeddings):
+            return self._embeddings_tool.embed_queries(questions)
+        return self._embeddings_tool.embed_documents(questions)
+
+    def _retrieve(self, embedding: List[float], k: Optional[int] = None, where: Optional[Dict] = None) -> List:
+        # the filter goes to chroma, which narrows the candidates before the vector search
+        filters = {"filter": where} if where else {}
+        return self.vector_store.similarity_search_by_vector(embedding, k=k or RETRIEVAL_K, **filters)
+
+    def _retrieve_many(
+        self,
+        embeddings: List[List[float]],
+        ks: List[Optional[int]],
+        wheres: Optional[List[Optional[Dict]]] = None,
+    ) -> List[List]:
+        wheres = wheres or [None] * len(embeddings)
+        # one chroma query takes one filter, so questions are searched per filter
+        groups: Dict[str, List[int]] = {}
+        for i, where in enumerate(wheres):
+            groups.setdefault(json.dumps(where, sort_keys=True), []).append(i)
+
+        found: List[List] = [[] for _ in embeddings]
+        for indices in groups.values():
+            results = self._search_vectors(
+                [embeddings[i] for i in indices], [ks[i] for i in indices], wheres[indices[0]]
+            )
+            for i, result in zip(indices, results):
+                found[i] = result
+        return found
+
+    def _search_vectors(self, embeddings: List[List[float]], ks: List[Optional[int]], where: Optional[Dict]) -> List[List]:
+        if len(embeddings) <= 1:
+            return [self._retrieve(embedding, k, where) for embedding, k in zip(embeddings, ks)]
+        # the langchain wrapper only searches one vector at a time, chroma itself takes a list
+        filters = {"where": where} if where else {}
+        result = self.vector_store._collection.query(
+            query_embeddings=embeddings,
+            n_results=max(k or RETRIEVAL_K for k in ks),
+            include=["documents", "metadatas"],
+            **filters,
+        )
+        return [
+            [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)][: k or RETRIEVAL_K]
+            for texts, metadatas, k in zip(result["documents"], result["metadatas"], ks)
+        ]
+
+    def _fuse(self, question: str, k: Optional[int], vector_docs: List, where: Optional[Dict] = None) -> List:
+        # exact part numbers and error codes are where embeddings are weakest,
+        # so keyword hits are merged in by reciprocal rank
+        k = k or RETRIEVAL_K
+        keyword_docs = [
+            Document(page_content=text, metadata=metadata)
+            for _, text, metadata, _ in self.lexical_index.search(question, k, where)
+        ]
+        if not keyword_docs:
+            return vector_docs
+
+        scores: Dict[str, float] = {}
+        docs: Dict[str, Document] = {}
+        for ranking in (vector_docs, keyword_docs):
+            for rank, doc in enumerate(ranking):
+                # per document, like the stored chunks, so a passage two manuals
+                # share keeps both sources
+                key = self.chunk_id(doc.page_content, (getattr(doc, "metadata", None) or {}).get("doc_id"))
+                docs.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        return [docs[key] for key in ranked[:k]]
+
+    def _build_prompt(self, docs: List, question: str, max_new_tokens: Optional[int] = None) -> Tuple[str, List]:
+        answer_tokens = max_new_tokens or GENERATION_DEFAULTS["max_new_tokens"]
+        window = CONTEXT_LENGTH - answer_tokens - self._count_tokens(QA_PROMPT.format(context="", question=question))
+        if window < 0:
+            raise ValueError("question is too long for the model context.")
+
+        packed = self._pack_context(docs, min(window, CONTEXT_TOKEN_BUDGET))
+        context = "\n\n".join(doc.page_content for doc in packed)
+        return QA_PROMPT.format(context=context, question=question), packed
+
+    def _pack_context(self, docs: List, budget: int) -> List:
+        # docs come in relevance order, so the best chunks are kept whole and
+        # only the last one that fits is cut short
+        packed, seen = [], []
+        for doc in docs:
+            text = " ".join(doc.page_content.split())
+            if not text or any(text in kept for kept in seen):
+                continue
+            cost = self._count_tokens(doc.page_content + "\n\n")
+            if cost <= budget:
+                packed.append(doc)
+            elif budget >= MIN_TRIMMED_TOKENS:
+                packed.append(Document(page_content=self._trim_to_tokens(doc.page_content, budget), metadata=doc.metadata))
+            else:
+                break
+            seen.append(text)
+            budget -= min(cost, budget)
+        return packed
+
+    def _trim_to_tokens(self, text: str, budget: int) -> str:
+        trimmed = text
+        while trimmed and self._count_tokens(trimmed + "\n\n") > budget:
+            # shrink in proportion to the overshoot and end on a word boundary
+            keep = int(len(trimmed) * budget / self._count_tokens(trimmed + "\n\n"))
+            trimmed = trimmed[: min(keep, len(trimmed) - 1)].rsplit(" ", 1)[0]
+        return trimmed
+
+    def _count_tokens(self, text: str) -> int:
+        if self.llm is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self.backend.tokenize(self.llm, text))
+
+    def _generate(
+        self,
+        llm,
+        prompt: str,
+        deadline: float,
+        cancel: Optional[threading.Event] = None,
+        **overrides,
+    ) -> Iterator[str]:
+        params = {key: value for key, value in overrides.items() if value is not None}
+        started = time.perf_counter()
+        first_token_at = None
+        count = 0
+        for token in self.backend.stream(llm, prompt, **params):
+            if first_token_at is None:
+                # the backend evaluates the prompt before it yields anything
+                first_token_at = time.perf_counter()
+                GENERATION_STAGE_SECONDS.observe(first_token_at - started, stage="prompt_eval")
+            if cancel is not None and cancel.is_set():
+                raise InferenceCancelledError("request cancelled during generation.")
+            if time.monotonic() >= deadline:
+                raise InferenceTimeoutError("generation timed out.", self.inference.retry_after())
+            count += 1
+            yield token
+
+        GENERATED_TOKENS.inc(count)
+        if first_token_at is not None:
+            decode = time.perf_counter() - first_token_at
+            GENERATION_STAGE_SECONDS.observe(decode, stage="decode")
+            if count > 1 and decode > 0:
+                GENERATION_TOKENS_PER_SECOND.observe((count - 1) / decode)
+
+    def _describe_sources(self, docs: List) -> List[Dict]:
+        sources = []
+        for doc in docs:
+            metadata = getattr(doc, "metadata", None) or {}
+            sources.append({
+                "source": metadata.get("filename") or os.path.basename(str(metadata.get("source", ""))),
+                "doc_id": metadata.get("doc_id"),
+                "page": metadata.get("page"),
+                "snippet": doc.page_content[:SNIPPET_LENGTH],
+            })
+        return sources
+
+
+def _deadline(timeout: Optional[float]) -> float:
+    # the timeout covers queueing and generation; 0 lifts it for offline runs
+    # that would rather wait their turn than fail
+    if timeout is None:
+        timeout = LLM_REQUEST_TIMEOUT
+    return time.monotonic() + (timeout if timeout > 0 else math.inf)
+
+
+def _record_stage(timings: Optional[Dict], stage: str, started: float) -> float:
+    now = time.perf_counter()
+    QUERY_STAGE_SECONDS.observe(now - started, stage=stage)
+    if timings is not None:
+        timings[stage] = round(now - started, 4)
+    return now
+
+
+def _finish_query(mode: str, outcome: str, received: float):
+    QUERY_SECONDS.observe(time.perf_counter() - received, mode=mode, outcome=outcome)
+
+
+def _available_memory() -> Optional[int]:
+    host = _host_available_memory()
+    # inside a container meminfo describes the host, and the cgroup limit is
+    # what the oom killer enforces
+    container = _cgroup_available_memory()
+    if host is None or container is None:
+        return host if container is None else container
+    return min(host, container)
+
+
+def _host_available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _cgroup_available_memory() -> Optional[int]:
+    for limit_path, usage_path in CGROUP_MEMORY_FILES:
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        # v2 writes "max" and v1 a huge number when there is no limit
+        if limit == "max" or int(limit) >= 1 << 60:
+            return None
+        return max(int(limit) - usage, 0)
+    return None
+
 
 rag_engine = RagEngine()
@@ -0,0 +1,74 @@
+"""Embedding throughput (chunks/second) of all-MiniLM-L6-v2 under different engine settings.
+
+Needs the real sentence-transformers model. Every combination of the given
+settings is loaded through RagEngine._load_embeddings, warmed up, and then
+timed over the same synthetic chunks.
+
+    python benchmarks/bench_embeddings.py --chunks 2000 --batch-sizes 16,32,64,128 --threads 1,4 --processes 0,4
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import rag
+
+WORDS = "torque valve pressure sensor firmware reset voltage bracket assembly calibration error code".split()
+
+
+def synthetic_chunks(count: int, length: int = 700):
+    rng = random.Random(0)
+    chunks = []
+    for i in range(count):
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(rng.choice(WORDS))
+        chunks.append(f"PN-{i:05d} " + " ".join(words))
+    return chunks
+
+
+def int_list(value: str):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--ingest-batch", type=int, default=rag.INGEST_BATCH_SIZE)
+    parser.add_argument("--batch-sizes", type=int_list, default=[32])
+    parser.add_argument("--threads", type=int_list, default=[0])
+    parser.add_argument("--processes", type=int_list, default=[0])
+    parser.add_argument("--normalize", choices=["off", "on", "both"], default="off")
+    args = parser.parse_args()
+
+    texts = synthetic_chunks(args.chunks)
+    normalize_options = {"off": [False], "on": [True], "both": [False, True]}[args.normalize]
+
+    print(f"{'batch':>6} {'threads':>7} {'procs':>5} {'norm':>5} {'chunks/s':>10}")
+    for batch_size, threads, processes, normalize in itertools.product(
+        args.batch_sizes, args.threads, args.processes, normalize_options
+    ):
+        rag.EMBEDDING_BATCH_SIZE = batch_size
+        rag.EMBEDDING_THREADS = threads
+        rag.EMBEDDING_PROCESSES = processes
+        rag.EMBEDDING_NORMALIZE = normalize
+        embeddings = rag.RagEngine()._load_embeddings()
+
+        embeddings.embed_documents(texts[: args.ingest_batch])
+        start = time.perf_counter()
+        # same call pattern as ingestion: one embed call per ingest batch
+        for offset in range(0, len(texts), args.ingest_batch):
+            embeddings.embed_documents(texts[offset : offset + args.ingest_batch])
+        elapsed = time.perf_counter() - start
+
+        if hasattr(embeddings, "close"):
+            embeddings.close()
+        print(f"{batch_size:>6} {threads:>7} {processes:>5} {str(normalize):>5} {len(texts) / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""End-to-end ingestion and query benchmark on synthetic PDFs.
+
+Generates PDFs of a controlled size, parses and indexes them into a real
+Chroma store and keyword index, then times questions through
+RagEngine.query. By default embeddings and the LLM are deterministic fakes
+so runs are CPU-only and comparable between machines and commits;
+--real-models loads the configured embedding model and LLM instead.
+
+    python benchmarks/bench_end_to_end.py --documents 20 --pages 40 --queries 200
+    python benchmarks/bench_end_to_end.py --save-baseline benchmarks/baselines/local.json
+    python benchmarks/bench_end_to_end.py --baseline benchmarks/baselines/local.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from app import pdf, rag
+from app.catalog import DocumentCatalog
+from app.lexical import LexicalIndex
+
+WORDS = (
+    "torque valve pressure sensor firmware reset voltage bracket assembly calibration error code pump seal "
+    "gasket bearing shaft motor relay fuse controller display alarm filter hose clamp manifold coupling "
+    "inspect replace tighten loosen measure install remove check adjust clean lubricate align verify"
+).split()
+# metrics where a larger number is better; everything else regresses upwards
+HIGHER_IS_BETTER = {"parse_pages_per_second", "index_chunks_per_second", "ingest_pages_per_second", "queries_per_second"}
+
+
+def synthetic_page(rng: random.Random, document: int, page: int, words: int) -> str:
+    text = [rng.choice(WORDS) for _ in range(words)]
+    text.insert(rng.randrange(len(text)), f"PN-{document:04d}-{page:04d}")
+    return " ".join(text)
+
+
+def write_pdf(path: str, pages):
+    # a minimal single-font pdf; pypdf extracts the Tj text exactly, and
+    # writing it by hand keeps the benchmark free of extra dependencies
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines, line = [], []
+        for word in text.split():
+            line.append(word)
+            if len(line) == 12:
+                lines.append(" ".join(line))
+                line = []
+        if line:
+            lines.append(" ".join(line))
+        stream = "BT /F1 10 Tf 50 780 Td 12 TL " + " ".join(f"({value}) Tj T*" for value in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        content = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {content} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    body = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(body))
+        body += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(body)
+    body += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    body += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    body += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(body)
+
+
+def build_corpus(directory: str, documents: int, pages: int, words: int):
+    rng = random.Random(0)
+    paths = []
+    for document in range(documents):
+        path = os.path.join(directory, f"manual-{document:04d}.pdf")
+        write_pdf(path, [synthetic_page(rng, document, page, words) for page in range(pages)])
+        paths.append(path)
+    return paths
+
+
+class FakeModel:
+    """Stands in for the ctransformers model the default backend drives."""
+
+    def __init__(self, tokens: int, token_ms: float):
+        self._tokens = tokens
+        self._delay = token_ms / 1000
+
+    def __call__(self, prompt, stream=True, **params):
+        for n in range(min(self._tokens, params.get("max_new_tokens", self._tokens))):
+            if self._delay:
+                time.sleep(self._delay)
+            yield f" word{n}"
+
+    def tokenize(self, text):
+        return text.split()
+
+
+class FakeLLM:
+    def __init__(self, tokens: int, token_ms: float):
+        self.client = FakeModel(tokens, token_ms)
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux; parse workers show up as children
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+
+def make_engine(args, workdir):
+    engine = rag.RagEngine()
+    if args.real_models:
+        engine.initialize()
+        return engine
+    embeddings = DeterministicFakeEmbedding(size=384)
+    engine._embeddings_tool = embeddings
+    engine.vector_store = Chroma(persist_directory=os.path.join(workdir, "chroma"), embedding_function=embeddings)
+    engine.catalog = DocumentCatalog(os.path.join(workdir, "documents.sqlite3"))
+    if rag.HYBRID_RETRIEVAL:
+        engine.lexical_index = LexicalIndex(os.path.join(workdir, "lexical.sqlite3"))
+    engine.llm = FakeLLM(args.answer_tokens, args.token_ms)
+    return engine
+
+
+def run_ingest(engine, paths):
+    # the streaming path the api and cli take: pages are parsed lazily while
+    # earlier batches are embedded and stored, so parsing is timed as the
+    # chunks are pulled and indexing is whatever is left
+    pages = chunks = 0
+    parse_seconds = ingest_seconds = 0.0
+    iter_chunks = engine.iter_chunks
+
+    def timed_chunks(*args, **kwargs):
+        nonlocal parse_seconds
+        source = iter_chunks(*args, **kwargs)
+        while True:
+            start = time.perf_counter()
+            chunk = next(source, None)
+            parse_seconds += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
+
+    def on_progress(stage, count):
+        nonlocal pages
+        if stage == "pages_parsed":
+            pages += count
+
+    engine.iter_chunks = timed_chunks
+    try:
+        for path in paths:
+            start = time.perf_counter()
+            chunks += engine.ingest_document(path, on_progress=on_progress)
+            ingest_seconds += time.perf_counter() - start
+    finally:
+        engine.iter_chunks = iter_chunks
+    return {
+        "pages": pages,
+        "chunks": chunks,
+        "parse_pages_per_second": round(pages / parse_seconds, 2),
+        "index_chunks_per_second": round(chunks / (ingest_seconds - parse_seconds), 2),
+        "ingest_pages_per_second": round(pages / ingest_seconds, 2),
+    }
+
+
+def check_answer(answer, args):
+    # a broken pipeline must fail the run, not be timed as if it answered;
+    # the fake model always starts its answer with the same token
+    if not args.real_models:
+        assert answer.split()[:1] == ["word0"], answer
+
+
+def run_queries(engine, args):
+    rng = random.Random(1)
+    questions = [
+        f"what is the torque for PN-{rng.randrange(args.documents):04d}-{rng.randrange(args.pages):04d} "
+        f"on the {rng.choice(WORDS)} {rng.choice(WORDS)}?"
+        for _ in range(args.queries)
+    ]
+    latencies = []
+    lock = threading.Lock()
+
+    def ask(question):
+        start = time.perf_counter()
+        answer = engine.query(question, raise_errors=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        check_answer(answer, args)
+        with lock:
+            latencies.append(elapsed)
+
+    check_answer(engine.query("warm up question", raise_errors=True), args)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(ask, questions))
+    seconds = time.perf_counter() - start
+    return {
+        "queries_per_second": round(len(questions) / seconds, 2),
+        "query_p50_ms": round(percentile(latencies, 0.5), 2),
+        "query_p95_ms": round(percentile(latencies, 0.95), 2),
+        "query_p99_ms": round(percentile(latencies, 0.99), 2),
+        "query_mean_ms": round(statistics.fmean(latencies), 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for metric, before in baseline["metrics"].items():
+        after = results["metrics"].get(metric)
+        if after is None or not before or metric in ("pages", "chunks"):
+            continue
+        change = (after - before) / before
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        print(f"{metric:<26} {before:>12} -> {after:>12} {change:+8.1%} {flag}")
+        if flag:
+            regressions.append(metric)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--answer-tokens", type=int, default=32)
+    parser.add_argument("--token-ms", type=float, default=0.0, help="simulated time per generated token.")
+    parser.add_argument("--real-models", action="store_true", help="use the configured embedding model and llm.")
+    parser.add_argument("--save-baseline", help="write the results to this json file.")
+    parser.add_argument("--baseline", help="compare against a saved baseline and exit 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown per metric.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="pdhelp-bench-")
+    try:
+        paths = build_corpus(workdir, args.documents, args.pages, args.words_per_page)
+        engine = make_engine(args, workdir)
+        metrics = run_ingest(engine, paths)
+        metrics.update(run_queries(engine, args))
+        # parse workers only count towards RUSAGE_CHILDREN once they have exited
+        pdf.shutdown_pool()
+        metrics["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        pdf.shutdown_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("save_baseline", "baseline", "tolerance")},
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "metrics": metrics,
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != results["config"] or baseline["machine"] != results["machine"]:
+            print("warning: the baseline was recorded with a different config or machine")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Keyword index lookup latency at scale, on synthetic manual chunks.
+
+Builds an index of --chunks chunks (or reuses the one at --path), then times
+mixed queries: part numbers, error codes and ordinary words.
+
+    python benchmarks/bench_lexical.py --chunks 1000000 --path /tmp/lexical_bench.sqlite3
+"""
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.lexical import LexicalIndex
+
+WORDS = (
+    "torque valve pressure sensor firmware reset voltage bracket assembly calibration error code pump seal "
+    "gasket bearing shaft motor relay fuse controller display alarm filter hose clamp manifold coupling"
+).split()
+
+
+def synthetic_chunk(rng: random.Random, n: int) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(60, 110))]
+    words.insert(rng.randrange(len(words)), f"PN-{n:07d}")
+    if n % 3 == 0:
+        words.insert(rng.randrange(len(words)), f"E-{n % 9973}")
+    return " ".join(words)
+
+
+def build(index: LexicalIndex, chunks: int, batch: int = 5000):
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for offset in range(0, chunks, batch):
+        texts = [synthetic_chunk(rng, n) for n in range(offset, min(offset + batch, chunks))]
+        ids = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        index.add(ids, texts, [{"page": n} for n in range(offset, offset + len(texts))])
+    print(f"indexed {chunks} chunks in {time.perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--path", default="/tmp/lexical_bench.sqlite3")
+    args = parser.parse_args()
+
+    index = LexicalIndex(args.path)
+    if index.size() < args.chunks:
+        build(index, args.chunks)
+
+    rng = random.Random(1)
+    kinds = {
+        "part number": lambda: f"what is the torque for PN-{rng.randrange(args.chunks):07d}?",
+        "error code": lambda: f"what does error E-{rng.randrange(9973)} mean?",
+        "common words": lambda: "how do I reset the pressure sensor calibration?",
+    }
+    print(f"{'query':>14} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, make in kinds.items():
+        samples = []
+        for _ in range(args.queries):
+            question = make()
+            start = time.perf_counter()
+            index.search(question, k=3)
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        p99 = samples[int(len(samples) * 0.99) - 1]
+        print(f"{name:>14} {statistics.median(samples) * 1000:>8.3f} {p99 * 1000:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Time to first token with and without the primed prompt prefix, on the real model.
+
+Needs the GGUF model and ctransformers >= 0.2.27. Each query gets a different
+context, so the only thing the model can reuse between queries is the static
+preamble; the baseline clears the model state before every call.
+
+    python benchmarks/bench_prefix_reuse.py --queries 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document
+
+from app import rag
+
+
+def first_token_seconds(engine, llm, prompt):
+    start = time.perf_counter()
+    tokens = engine._generate(llm, prompt, time.monotonic() + 600, max_new_tokens=1)
+    next(tokens, None)
+    tokens.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=10)
+    args = parser.parse_args()
+
+    engine = rag.RagEngine()
+    engine._download_model_if_needed()
+    llm = engine._new_llm(engine._backend_settings(1))
+    engine.llm = llm
+
+    prompts = []
+    for number in range(args.queries):
+        docs = [Document(page_content=f"Part {number} uses a torque of {number * 7} Nm on the M{number + 4} bolts.")]
+        prompts.append(engine._build_prompt(docs, f"what torque does part {number} need?")[0])
+
+    baseline = []
+    for prompt in prompts:
+        # drop everything the model holds, as a backend without prefix reuse would
+        llm.client.prepare_inputs_for_generation(llm.client.tokenize(prompt)[:1])
+        baseline.append(first_token_seconds(engine, llm, prompt))
+
+    engine._prime_prompt_prefix(llm)
+    primed = [first_token_seconds(engine, llm, prompt) for prompt in prompts]
+
+    prefix_tokens = len(llm.client.tokenize(rag.PROMPT_PREFIX))
+    print(f"static prefix: {prefix_tokens} tokens")
+    print(f"{'mode':>10} {'median ms':>10} {'mean ms':>10}")
+    for name, samples in (("no reuse", baseline), ("primed", primed)):
+        print(f"{name:>10} {statistics.median(samples) * 1000:>10.1f} {statistics.mean(samples) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
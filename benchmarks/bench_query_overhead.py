@@ -0,0 +1,112 @@
+"""Per-query pipeline overhead: RetrievalQA built per call vs the engine's reused pipeline.
+
+Retrieval and generation are replaced with constant-time fakes so the
+numbers isolate the cost of the orchestration itself.
+
+    python benchmarks/bench_query_overhead.py --iterations 500
+"""
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.chains import RetrievalQA
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake import FakeListLLM
+from langchain_core.vectorstores import VectorStore
+
+from app import rag
+from app.cache import SemanticAnswerCache
+from app.rag import RETRIEVAL_K, RagEngine
+
+
+class FixedResultStore(VectorStore):
+    def __init__(self, docs):
+        self._docs = docs
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self._docs[:k]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return self._docs[:k]
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+
+class FakeClient:
+    def __call__(self, prompt, stream=True, **params):
+        return iter(["answer"])
+
+    def tokenize(self, text):
+        return text.split()
+
+
+def per_query_chain(store, llm, question):
+    retriever = store.as_retriever(search_kwargs={"k": RETRIEVAL_K})
+    qa_chain = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever)
+    return qa_chain.invoke(question)["result"]
+
+
+def construction_only(store, llm, question):
+    retriever = store.as_retriever(search_kwargs={"k": RETRIEVAL_K})
+    RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever)
+
+
+def engine_query(engine, question):
+    # a failing query returns an error string instead of raising, which
+    # would otherwise be timed as if it were the pipeline
+    answer = engine.query(question)
+    assert answer == "answer", answer
+
+
+def timed(fn, iterations: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=300)
+    args = parser.parse_args()
+
+    store = FixedResultStore([Document(page_content=f"passage {i} about part PN-{i:05d}") for i in range(10)])
+    llm = FakeListLLM(responses=["answer"])
+    question = "which part is PN-00042?"
+
+    # no batching window, keyword index or answer cache, so every query runs
+    # the whole pipeline on the calling thread
+    rag.RETRIEVAL_BATCH_WAIT_MS = 0
+    engine = RagEngine()
+    engine.vector_store = store
+    engine.lexical_index = None
+    engine.answer_cache = SemanticAnswerCache(max_entries=0)
+    engine._embeddings_tool = DeterministicFakeEmbedding(size=384)
+    engine.llm = SimpleNamespace(client=FakeClient())
+
+    results = {
+        "chain construction only": timed(lambda: construction_only(store, llm, question), args.iterations),
+        "RetrievalQA built per query": timed(lambda: per_query_chain(store, llm, question), args.iterations),
+        "RagEngine.query (reused pipeline)": timed(lambda: engine_query(engine, question), args.iterations),
+    }
+
+    for name, micros in results.items():
+        print(f"{name:<36} {micros:10.1f} us/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+from unittest.mock import patch
+
+from app.cache import SemanticAnswerCache
+
+
+def test_hit_within_threshold_and_miss_outside():
+    cache = SemanticAnswerCache(max_entries=4, ttl=60, threshold=0.9)
+    cache.put([1.0, 0.0], "v1", "answer")
+
+    assert cache.get([2.0, 0.1], "v1") == "answer"
+    assert cache.get([0.0, 1.0], "v1") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_scope_must_match():
+    cache = SemanticAnswerCache(max_entries=4, ttl=60, threshold=0.9)
+    cache.put([1.0, 0.0], ("v1", 3), "answer")
+
+    assert cache.get([1.0, 0.0], ("v2", 3)) is None
+    assert cache.get([1.0, 0.0], ("v1", 5)) is None
+
+
+def test_lru_eviction_keeps_recently_used():
+    cache = SemanticAnswerCache(max_entries=2, ttl=60, threshold=0.99)
+    cache.put([1.0, 0.0, 0.0], "v", "a")
+    cache.put([0.0, 1.0, 0.0], "v", "b")
+    assert cache.get([1.0, 0.0, 0.0], "v") == "a"
+
+    cache.put([0.0, 0.0, 1.0], "v", "c")
+
+    assert cache.get([0.0, 1.0, 0.0], "v") is None
+    assert cache.get([1.0, 0.0, 0.0], "v") == "a"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiry():
+    cache = SemanticAnswerCache(max_entries=2, ttl=10, threshold=0.9)
+    with patch("app.cache.time.monotonic", return_value=100.0):
+        cache.put([1.0, 0.0], "v", "a")
+    with patch("app.cache.time.monotonic", return_value=111.0):
+        assert cache.get([1.0, 0.0], "v") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_disabled_cache_never_stores():
+    cache = SemanticAnswerCache(max_entries=0)
+    cache.put([1.0], "v", "a")
+    assert cache.get([1.0], "v") is None
+    assert cache.stats()["enabled"] is False
@@ -1,9 +1,14 @@
 import sys
+import threading
 from unittest.mock import MagicMock, patch
 import pytest
 
 @pytest.fixture(autouse=True)
-def reset_mocks():
+def reset_mocks(tmp_path, monkeypatch):
+    # app.rag is re-imported below, so the keyword index and catalog land in the test's directory
+    monkeypatch.setenv("PDHELP_LEXICAL_INDEX_PATH", str(tmp_path / "lexical_index.sqlite3"))
+    monkeypatch.setenv("PDHELP_CATALOG_PATH", str(tmp_path / "documents.sqlite3"))
+
     # --- step 0: ensure app modules are not already loaded ---
     for module_name in list(sys.modules.keys()):
         if module_name.startswith("app.") or module_name == "app":
@@ -114,39 +119,174 @@ async def test_lifespan_success():
     from app.main import lifespan
 
     with patch("app.main.rag_engine") as mock_engine:
-        mock_engine.initialize.return_value = None
-        mock_engine.vector_store = MagicMock()
-        mock_engine.llm = MagicMock()
-
         async with lifespan(MagicMock()):
             pass
 
-        mock_engine.initialize.assert_called_once()
+        mock_engine.start_loading.assert_called_once()
+        mock_engine.initialize.assert_not_called()
 
-@pytest.mark.asyncio
-async def test_lifespan_failure_initialize():
-    from app.main import lifespan
+def test_components_load_concurrently():
+    from app.rag import RagEngine
+    engine = RagEngine()
+    engine._download_model_if_needed = MagicMock()
+    sys.modules["langchain_community.embeddings"].HuggingFaceEmbeddings.side_effect = None
+    sys.modules["langchain_chroma"].Chroma.side_effect = None
+    sys.modules["langchain_community.llms"].CTransformers.side_effect = None
 
-    with patch("app.main.rag_engine") as mock_engine:
-        mock_engine.initialize.side_effect = Exception("init failed")
+    barrier = threading.Barrier(3, timeout=5)
 
-        with pytest.raises(Exception) as excinfo:
-            async with lifespan(MagicMock()):
-                pass
+    def arrive(*args, **kwargs):
+        # every loader has to be running at the same time to get past the barrier
+        barrier.wait()
+        return MagicMock()
 
-        assert "init failed" in str(excinfo.value)
+    sys.modules["langchain_community.embeddings"].HuggingFaceEmbeddings.side_effect = arrive
+    sys.modules["langchain_chroma"].Chroma.side_effect = arrive
+    sys.modules["langchain_community.llms"].CTransformers.side_effect = arrive
 
-@pytest.mark.asyncio
-async def test_lifespan_failure_vector_store_none():
-    from app.main import lifespan
+    with patch("app.rag.EMBEDDING_CACHE_SIZE", 0):
+        engine.initialize()
 
-    with patch("app.main.rag_engine") as mock_engine:
-        mock_engine.initialize.return_value = None
-        mock_engine.vector_store = None
-        mock_engine.llm = MagicMock()
+    assert engine.is_ready()
+    assert all(status["seconds"] is not None for status in engine.readiness().values())
+
+def test_component_failure_reported_without_blocking_others(capsys):
+    from app.rag import RagEngine
+    engine = RagEngine()
+    engine._download_model_if_needed = MagicMock(side_effect=Exception("network down"))
+    sys.modules["langchain_community.embeddings"].HuggingFaceEmbeddings.side_effect = None
+    sys.modules["langchain_chroma"].Chroma.side_effect = None
+
+    engine.start_loading()
+    engine.wait_until_loaded()
+
+    assert engine.is_ready("embeddings", "vector_store")
+    assert not engine.is_ready()
+    assert engine.readiness()["llm"] == {"state": "failed", "seconds": engine.readiness()["llm"]["seconds"], "error": "network down"}
+
+def test_initialize_applies_embedding_settings():
+    from app import rag
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
+
+    hf_class = sys.modules["langchain_community.embeddings"].HuggingFaceEmbeddings
+    sys.modules["langchain_chroma"].Chroma.side_effect = None
+    sys.modules["langchain_community.llms"].CTransformers.side_effect = None
+
+    with patch.object(rag, "EMBEDDING_BATCH_SIZE", 128), \
+         patch.object(rag, "EMBEDDING_NORMALIZE", True), \
+         patch.object(rag, "EMBEDDING_PROCESSES", 0), \
+         patch.object(rag, "EMBEDDING_CACHE_SIZE", 0):
+        engine.initialize()
+
+    hf_class.assert_called_once_with(
+        model_name=rag.EMBEDDING_NAME,
+        encode_kwargs={"batch_size": 128, "normalize_embeddings": True},
+    )
+    assert engine._embeddings_tool is hf_class.return_value
+
+def test_initialize_uses_pooled_embeddings_when_configured():
+    from app import rag
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
+    sys.modules["langchain_chroma"].Chroma.side_effect = None
+    sys.modules["langchain_community.llms"].CTransformers.side_effect = None
+
+    with patch.object(rag, "EMBEDDING_PROCESSES", 4), \
+         patch.object(rag, "EMBEDDING_CACHE_SIZE", 0), \
+         patch.object(rag, "PooledEmbeddings") as pooled:
+        engine.initialize()
+
+    model = sys.modules["langchain_community.embeddings"].HuggingFaceEmbeddings.return_value.client
+    pooled.assert_called_once_with(model, 4, rag.EMBEDDING_BATCH_SIZE, rag.EMBEDDING_NORMALIZE)
+    assert engine._embeddings_tool is pooled.return_value
+
+def test_initialize_wraps_embeddings_in_disk_cache(tmp_path):
+    from app import rag
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
+    sys.modules["langchain_chroma"].Chroma.side_effect = None
+    sys.modules["langchain_community.llms"].CTransformers.side_effect = None
+    cache_path = tmp_path / "embeddings.sqlite3"
+
+    with patch.object(rag, "EMBEDDING_CACHE_PATH", str(cache_path)), patch.object(rag, "EMBEDDING_CACHE_SIZE", 10):
+        engine.initialize()
+
+    assert isinstance(engine._embeddings_tool, rag.CachedEmbeddings)
+    store_embeddings = sys.modules["langchain_chroma"].Chroma.call_args.kwargs["embedding_function"]
+    assert store_embeddings._wait() is engine._embeddings_tool
+    # the database is only created once something is embedded
+    assert not cache_path.exists()
+
+def test_ctransformers_backend_receives_tuning_settings():
+    from app import rag
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
+    ct_class = sys.modules["langchain_community.llms"].CTransformers
+    ct_class.side_effect = None
+
+    with patch.object(rag, "LLM_THREADS", 6), \
+         patch.object(rag, "LLM_BATCH_SIZE", 64), \
+         patch.object(rag, "LLM_MLOCK", True):
+        engine._load_llm()
+
+    ct_class.assert_called_once_with(
+        model=rag.MODEL_PATH,
+        model_type="llama",
+        config={
+            **rag.GENERATION_DEFAULTS,
+            "context_length": rag.CONTEXT_LENGTH,
+            "mmap": True,
+            "mlock": True,
+            "threads": 6,
+            "batch_size": 64,
+        },
+    )
+    assert engine.backend.name == "ctransformers"
+
+def test_llama_cpp_backend_is_selectable_by_config():
+    from app import rag
+    llama_cpp = MagicMock()
+    model = llama_cpp.Llama.return_value
+    model.create_completion.side_effect = lambda prompt, stream=False, **kwargs: iter(
+        [{"choices": [{"text": "42"}]}, {"choices": [{"text": " Nm"}]}]
+    )
+    model.tokenize.side_effect = lambda text, add_bos: text.split()
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
+
+    with patch.dict(sys.modules, {"llama_cpp": llama_cpp}), \
+         patch.object(rag, "LLM_BACKEND", "llama_cpp"), \
+         patch.object(rag, "LLM_THREADS", 4), \
+         patch.object(rag, "LLM_MMAP", False):
+        engine._load_llm()
+
+    llama_cpp.Llama.assert_called_once_with(
+        model_path=rag.MODEL_PATH,
+        n_ctx=rag.CONTEXT_LENGTH,
+        use_mmap=False,
+        use_mlock=False,
+        verbose=False,
+        n_threads=4,
+        n_threads_batch=4,
+    )
+    # the static preamble is evaluated once at load
+    assert model.create_completion.call_args_list[0].args == (rag.PROMPT_PREFIX,)
+
+    tokens = list(engine._generate(engine.llm, "torque?", deadline=float("inf"), max_new_tokens=8))
+    assert tokens == ["42", " Nm"]
+    assert model.create_completion.call_args.kwargs == {
+        "stream": True, "max_tokens": 8, "temperature": rag.GENERATION_DEFAULTS["temperature"],
+    }
+    assert engine._count_tokens("two words") == 2
+
+def test_unknown_backend_fails_the_llm_component():
+    from app import rag
+    engine = rag.RagEngine()
+    engine._download_model_if_needed = MagicMock()
 
-        with pytest.raises(RuntimeError) as excinfo:
-            async with lifespan(MagicMock()):
-                pass
+    with patch.object(rag, "LLM_BACKEND", "gpt"):
+        engine._run_loader("llm", engine._load_llm)
 
-        assert "initialization failed" in str(excinfo.value)
+    assert engine.components["llm"].state == "failed"
+    assert "unknown llm backend 'gpt'" in str(engine.components["llm"].error)
@@ -0,0 +1,72 @@
+import threading
+
+from app.batching import MicroBatcher
+
+
+def run_together(batcher, items):
+    results = {}
+    start = threading.Barrier(len(items))
+
+    def submit(item):
+        start.wait()
+        try:
+            results[item] = batcher.submit(item)
+        except Exception as e:
+            results[item] = e
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_items_share_one_batch_and_get_their_own_result():
+    calls = []
+
+    def handler(items):
+        calls.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(handler, max_batch=8, max_wait=0.2, name="test-batcher")
+    results = run_together(batcher, [1, 2, 3, 4])
+
+    assert results == {1: 10, 2: 20, 3: 30, 4: 40}
+    assert len(calls) == 1
+    assert sorted(calls[0]) == [1, 2, 3, 4]
+    assert batcher.stats() == {"batches": 1, "items": 4, "average_batch": 4.0, "largest_batch": 4}
+
+
+def test_batches_are_capped_at_max_batch():
+    sizes = []
+
+    def handler(items):
+        sizes.append(len(items))
+        return items
+
+    batcher = MicroBatcher(handler, max_batch=2, max_wait=0.2, name="test-batcher")
+    results = run_together(batcher, list(range(5)))
+
+    assert results == {i: i for i in range(5)}
+    assert max(sizes) == 2
+    assert sum(sizes) == 5
+
+
+def test_handler_error_reaches_every_waiter_and_batcher_keeps_running():
+    def handler(items):
+        if "bad" in items:
+            raise ValueError("search failed")
+        return items
+
+    batcher = MicroBatcher(handler, max_batch=8, max_wait=0.2, name="test-batcher")
+    results = run_together(batcher, ["bad", "good"])
+
+    assert all(isinstance(result, ValueError) for result in results.values())
+    assert batcher.submit("later") == "later"
+
+
+def test_lone_item_waits_at_most_the_window():
+    batcher = MicroBatcher(lambda items: items, max_batch=8, max_wait=0.01, name="test-batcher")
+    assert batcher.submit("alone") == "alone"
+    assert batcher.stats()["largest_batch"] == 1
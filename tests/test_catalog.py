@@ -0,0 +1,45 @@
+from app.catalog import DocumentCatalog
+
+
+def metadata(doc_id, revision, tags=""):
+    return {"doc_id": doc_id, "revision": revision, "filename": f"{doc_id}-{revision}.pdf", "file_sha256": revision, "tags": tags}
+
+
+def test_totals_accumulate_per_document_and_reopen(tmp_path):
+    path = str(tmp_path / "documents.sqlite3")
+    catalog = DocumentCatalog(path)
+    catalog.add(["ab", "cde"], [metadata("d1", "r1", "pumps"), metadata("d1", "r1", "pumps")])
+    catalog.add(["é", "x"], [metadata("d1", "r1", "pumps"), {"file_sha256": "s0", "filename": "legacy.pdf"}])
+    catalog.close()
+
+    reopened = DocumentCatalog(path)
+    assert reopened.documents() == [
+        {"doc_id": "d1", "filename": "d1-r1.pdf", "file_sha256": "r1", "tags": ["pumps"], "chunks": 3, "bytes": 7},
+        {"doc_id": None, "filename": "legacy.pdf", "file_sha256": "s0", "tags": [], "chunks": 1, "bytes": 1},
+    ]
+
+
+def test_removing_revisions_follows_replacement(tmp_path):
+    catalog = DocumentCatalog(str(tmp_path / "documents.sqlite3"))
+    catalog.add(["old"], [metadata("d1", "r1", "pumps")])
+    catalog.add(["newer"], [metadata("d1", "r2", "valves")])
+
+    # while both revisions are stored the newest one names the document
+    assert catalog.documents()[0]["tags"] == ["valves"]
+    assert catalog.documents()[0]["chunks"] == 2
+
+    catalog.remove("d1", keep="r2")
+    assert catalog.documents()[0]["bytes"] == 5
+
+    catalog.remove("d1", revision="r2")
+    assert catalog.documents() == []
+    assert catalog.size() == 0
+
+
+def test_an_unwritten_catalog_is_not_created(tmp_path):
+    path = tmp_path / "documents.sqlite3"
+    catalog = DocumentCatalog(str(path))
+    catalog.remove("d1")
+    assert catalog.documents() == []
+    assert catalog.size() == 0
+    assert not path.exists()
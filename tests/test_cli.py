@@ -0,0 +1,130 @@
+import json
+import sys
+from unittest.mock import MagicMock, patch
+
+for module_name in list(sys.modules.keys()):
+    if module_name.startswith("app.") or module_name == "app":
+        del sys.modules[module_name]
+
+sys.modules["langchain_text_splitters"] = MagicMock()
+sys.modules["langchain_community.embeddings"] = MagicMock()
+sys.modules["langchain_community.llms"] = MagicMock()
+sys.modules["langchain_chroma"] = MagicMock()
+
+from app import __main__ as cli
+from app import rag
+
+
+def test_index_walks_directories_and_skips_known_files(tmp_path, capsys):
+    (tmp_path / "manuals").mkdir()
+    (tmp_path / "manuals" / "pump.pdf").write_bytes(b"%PDF-1.4 pump")
+    (tmp_path / "valve.PDF").write_bytes(b"%PDF-1.4 valve")
+    (tmp_path / "empty.pdf").write_bytes(b"%PDF-1.4 empty")
+    (tmp_path / "notes.txt").write_text("not a pdf")
+
+    def ingest(path, on_progress, metadata):
+        if path.endswith("empty.pdf"):
+            return 0
+        on_progress("pages_parsed", 2)
+        on_progress("chunks_persisted", 5)
+        return 5
+
+    known = cli.sha256_file(str(tmp_path / "valve.PDF"))
+    engine = rag.rag_engine
+    with patch.object(engine, "initialize") as initialize, patch.object(
+        engine, "find_document", side_effect=lambda sha: {"doc_id": "d1"} if sha == known else None
+    ), patch.object(engine, "ingest_document", side_effect=ingest) as ingest_document:
+        output = tmp_path / "results.jsonl"
+        code = cli.main(["index", str(tmp_path), "--workers", "2", "--tags", "Pumps", "--output", str(output)])
+
+    initialize.assert_called_once_with("embeddings", "vector_store")
+    assert code == 1
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [(result["filename"], result["status"]) for result in results] == [
+        ("empty.pdf", "failed"),
+        ("valve.PDF", "already_indexed"),
+        ("manuals/pump.pdf", "completed"),
+    ]
+    metadata = ingest_document.call_args_list[-1].kwargs["metadata"]
+    assert metadata["filename"] == "manuals/pump.pdf"
+    assert metadata["tag_pumps"] is True
+
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["files"] == 3
+    assert summary["completed"] == 1
+    assert summary["pages_parsed"] == 2
+    assert summary["chunks_persisted"] == 5
+
+
+def test_ask_answers_jsonl_in_order_with_timings(tmp_path, capsys):
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text(
+        "\n".join([
+            json.dumps({"id": "q1", "question": "torque?", "k": 2}),
+            json.dumps("pressure?"),
+            "",
+            json.dumps({"question": "  "}),
+        ])
+    )
+
+    def query(question, timings, raise_errors=False, **overrides):
+        if question == "pressure?":
+            assert raise_errors
+            raise RuntimeError("embedding failed")
+        timings.update({"retrieval": 0.01, "generation": 0.5})
+        return f"{question} -> {overrides}"
+
+    engine = rag.rag_engine
+    with patch.object(engine, "initialize"), patch.object(engine, "query", side_effect=query):
+        output = tmp_path / "answers.jsonl"
+        code = cli.main(["ask", str(questions), "--output", str(output), "--max-new-tokens", "64"])
+
+    assert code == 1
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [result["id"] for result in results] == ["q1", 2, 4]
+    # the api deadline is lifted unless --timeout asks for one
+    assert results[0]["answer"] == "torque? -> {'max_new_tokens': 64, 'timeout': 0, 'k': 2}"
+    assert results[0]["timings"] == {"retrieval": 0.01, "generation": 0.5}
+    # a failed query is an error, not an answer reading "error processing request"
+    assert results[1]["error"] == "embedding failed"
+    assert "answer" not in results[1]
+    assert results[2]["error"] == "no question given."
+
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["questions"] == 3
+    assert summary["answered"] == 1
+    assert summary["errors"] == 2
+    assert summary["stages"]["generation"] == 0.5
+
+
+def test_index_removes_partial_chunks_of_a_failed_file(tmp_path, capsys):
+    (tmp_path / "pump.pdf").write_bytes(b"%PDF-1.4 pump")
+
+    engine = rag.rag_engine
+    with patch.object(engine, "initialize"), patch.object(engine, "find_document", return_value=None), patch.object(
+        engine, "ingest_document", side_effect=RuntimeError("embedding failed")
+    ) as ingest_document, patch.object(engine, "delete_document", return_value=64) as delete_document:
+        code = cli.main(["index", str(tmp_path)])
+
+    assert code == 1
+    # otherwise the next run would find the hash and skip the file
+    delete_document.assert_called_once_with(ingest_document.call_args.kwargs["metadata"]["doc_id"])
+    assert "removed 64 partial chunks of pump.pdf" in capsys.readouterr().out
+
+
+def test_index_skips_copies_of_a_file_within_one_run(tmp_path, capsys):
+    for name in ("a.pdf", "b.pdf", "c.pdf"):
+        (tmp_path / name).write_bytes(b"%PDF-1.4 same manual")
+
+    engine = rag.rag_engine
+    with patch.object(engine, "initialize"), patch.object(engine, "find_document", return_value=None), patch.object(
+        engine, "ingest_document", return_value=3
+    ) as ingest_document:
+        output = tmp_path / "results.jsonl"
+        code = cli.main(["index", str(tmp_path), "--workers", "3", "--output", str(output)])
+
+    assert code == 0
+    assert ingest_document.call_count == 1
+    statuses = sorted(json.loads(line)["status"] for line in output.read_text().splitlines())
+    assert statuses == ["completed", "duplicate", "duplicate"]
+    assert '"duplicate": 2' in capsys.readouterr().out
@@ -0,0 +1,89 @@
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+
+from app.embeddings import CachedEmbeddings, PooledEmbeddings
+
+
+def test_pool_started_once_and_reused():
+    model = MagicMock()
+    model.encode_multi_process.return_value = np.array([[0.1, 0.2], [0.3, 0.4]])
+    embeddings = PooledEmbeddings(model, processes=3, batch_size=64, normalize=True)
+
+    assert embeddings.embed_documents(["a", "b"]) == [[0.1, 0.2], [0.3, 0.4]]
+    embeddings.embed_documents(["c", "d"])
+
+    model.start_multi_process_pool.assert_called_once_with(target_devices=["cpu", "cpu", "cpu"])
+    assert model.encode_multi_process.call_args.kwargs == {"batch_size": 64, "normalize_embeddings": True}
+
+    embeddings.close()
+    model.stop_multi_process_pool.assert_called_once_with(model.start_multi_process_pool.return_value)
+
+
+def test_query_encoded_in_process():
+    model = MagicMock()
+    model.encode.return_value = np.array([1.0, 0.0])
+    embeddings = PooledEmbeddings(model, processes=2, batch_size=32, normalize=False)
+
+    assert embeddings.embed_query("question") == [1.0, 0.0]
+    model.encode_multi_process.assert_not_called()
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return [0.0, 0.0]
+
+
+def test_cache_skips_inner_model_for_known_texts(tmp_path):
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner, "model-a", str(tmp_path / "cache.sqlite3"), max_entries=100)
+
+    assert cache.embed_documents(["ab", "abc", "ab"]) == [[2.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+    assert cache.embed_documents(["abc", "abcd"]) == [[3.0, 1.0], [4.0, 1.0]]
+
+    # duplicates within a call and texts seen before never reach the model
+    assert inner.calls == [["ab", "abc"], ["abcd"]]
+    assert cache.stats()["hits"] == 2
+    cache.close()
+
+
+def test_cache_persists_and_is_keyed_by_model(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = CachedEmbeddings(CountingEmbeddings(), "model-a", path, max_entries=100)
+    first.embed_documents(["hello"])
+    first.close()
+
+    inner = CountingEmbeddings()
+    reopened = CachedEmbeddings(inner, "model-a", path, max_entries=100)
+    reopened.embed_documents(["hello"])
+    assert inner.calls == []
+    assert reopened.stats()["size"] == 1
+
+    other_model = CachedEmbeddings(inner, "model-b", path, max_entries=100)
+    other_model.embed_documents(["hello"])
+    assert inner.calls == [["hello"]]
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner, "model-a", str(tmp_path / "cache.sqlite3"), max_entries=2)
+
+    with patch("app.embeddings.time.time", side_effect=[1.0, 2.0, 3.0, 4.0, 5.0, 6.0]):
+        cache.embed_documents(["a"])
+        cache.embed_documents(["bb"])
+        cache.embed_documents(["a"])
+        cache.embed_documents(["ccc"])
+
+    assert cache.stats()["size"] == 2
+    inner.calls.clear()
+    cache.embed_documents(["a", "ccc"])
+    assert inner.calls == []
+    cache.embed_documents(["bb"])
+    assert inner.calls == [["bb"]]
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# importing app.main took about 1.1s while it pulled in chroma, the text
+# splitter and the llm wrappers, and about 0.6s once they were deferred
+IMPORT_BUDGET_SECONDS = float(os.getenv("PDHELP_IMPORT_BUDGET_SECONDS", "1.0"))
+DEFERRED_MODULES = (
+    "chromadb",
+    "langchain_chroma",
+    "langchain_community",
+    "langchain_text_splitters",
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "ctransformers",
+    "llama_cpp",
+    "pypdf",
+)
+SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app.main
+seconds = time.perf_counter() - started
+print(json.dumps({"seconds": seconds, "loaded": [name for name in %r if name in sys.modules]}))
+""" % (DEFERRED_MODULES,)
+
+
+def import_app():
+    # a fresh interpreter, since this one has the app and its mocks loaded already
+    output = subprocess.run([sys.executable, "-c", SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_import_defers_heavy_dependencies():
+    assert import_app()["loaded"] == []
+
+
+def test_import_stays_within_budget():
+    # the best of a few runs, so a busy machine does not fail the build
+    seconds = min(import_app()["seconds"] for _ in range(3))
+    print(f"\nimport app.main: {seconds * 1000:.0f} ms (budget {IMPORT_BUDGET_SECONDS * 1000:.0f} ms)")
+    assert seconds < IMPORT_BUDGET_SECONDS
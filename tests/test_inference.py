@@ -0,0 +1,359 @@
+import sys
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+for module_name in list(sys.modules.keys()):
+    if module_name.startswith("app.") or module_name == "app":
+        del sys.modules[module_name]
+
+sys.modules["langchain_text_splitters"] = MagicMock()
+sys.modules["langchain_community.embeddings"] = MagicMock()
+sys.modules["langchain_community.llms"] = MagicMock()
+sys.modules["langchain_chroma"] = MagicMock()
+
+from app import rag
+
+
+def deadline(seconds=5.0):
+    return time.monotonic() + seconds
+
+
+def test_idle_instances_are_handed_out_then_queue_is_fifo():
+    scheduler = rag.InferenceScheduler(queue_size=4)
+    scheduler.reset(["model"])
+    served = []
+
+    def request(name):
+        with scheduler.acquire(deadline()):
+            served.append(name)
+
+    with scheduler.acquire(deadline()) as instance:
+        assert instance == "model"
+        waiters = []
+        for name in ("first", "second", "third"):
+            thread = threading.Thread(target=request, args=(name,))
+            thread.start()
+            waiters.append(thread)
+            # make the arrival order deterministic
+            while scheduler.stats()["waiting"] < len(waiters):
+                time.sleep(0.01)
+        assert scheduler.stats() == {"instances": 1, "busy": 1, "waiting": 3, "queue_size": 4}
+
+    for thread in waiters:
+        thread.join(5)
+    assert served == ["first", "second", "third"]
+    assert scheduler.stats()["busy"] == 0
+
+
+def test_full_queue_is_rejected_with_retry_hint():
+    scheduler = rag.InferenceScheduler(queue_size=0)
+    scheduler.reset(["model"])
+
+    with scheduler.acquire(deadline()):
+        with pytest.raises(rag.InferenceQueueFullError) as error:
+            with scheduler.acquire(deadline()):
+                pass
+    assert error.value.retry_after >= 1
+
+
+def test_waiting_times_out_and_leaves_the_queue():
+    scheduler = rag.InferenceScheduler(queue_size=2)
+    scheduler.reset(["model"])
+
+    with scheduler.acquire(deadline()):
+        with pytest.raises(rag.InferenceTimeoutError):
+            with scheduler.acquire(deadline(0.05)):
+                pass
+        assert scheduler.stats()["waiting"] == 0
+
+    with scheduler.acquire(deadline()) as instance:
+        assert instance == "model"
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    scheduler = rag.InferenceScheduler(queue_size=2)
+    scheduler.reset(["model"])
+    cancel = threading.Event()
+    cancel.set()
+
+    with scheduler.acquire(deadline()):
+        with pytest.raises(rag.InferenceCancelledError):
+            with scheduler.acquire(deadline(), cancel):
+                pass
+        assert scheduler.stats()["waiting"] == 0
+
+
+def test_generation_stops_at_cancel_and_releases_instance():
+    engine = rag.RagEngine()
+    engine.vector_store = MagicMock()
+    engine.vector_store.similarity_search_by_vector.return_value = []
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_query.return_value = [1.0, 0.0]
+    engine.llm = MagicMock()
+    engine.llm.client.return_value = iter(["one", "two", "three"])
+    cancel = threading.Event()
+
+    events = engine.stream_query("question?", cancel=cancel)
+    assert next(events)["event"] == "sources"
+    assert next(events)["data"] == "one"
+    cancel.set()
+    with pytest.raises(rag.InferenceCancelledError):
+        next(events)
+
+    assert engine.inference.stats()["busy"] == 0
+    assert engine.answer_cache.stats()["size"] == 0
+
+
+def test_offline_queries_can_wait_past_the_request_timeout(monkeypatch):
+    monkeypatch.setattr(rag, "LLM_REQUEST_TIMEOUT", 0.05)
+    engine = rag.RagEngine()
+    engine.vector_store = MagicMock()
+    engine.vector_store.similarity_search_by_vector.return_value = []
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_query.return_value = [1.0, 0.0]
+    engine.llm = MagicMock()
+    engine.llm.client.side_effect = lambda prompt, stream=True, **params: iter(["answer"])
+
+    # another question holds the only instance for longer than the timeout
+    held = engine.inference.acquire(deadline())
+    held.__enter__()
+    with pytest.raises(rag.InferenceTimeoutError):
+        engine.query("question?")
+    threading.Timer(0.2, held.__exit__, (None, None, None)).start()
+    assert engine.query("question?", timeout=0) == "answer"
+
+
+def test_instance_budget_is_capped_by_memory(tmp_path, monkeypatch):
+    model = tmp_path / "model.gguf"
+    model.write_bytes(b"\0" * 1024)
+    monkeypatch.setattr(rag, "MODEL_PATH", str(model))
+    monkeypatch.setattr(rag, "LLM_INSTANCES", 4)
+    monkeypatch.setattr(rag, "LLM_INSTANCE_OVERHEAD", 1024)
+    monkeypatch.setattr(rag, "_available_memory", lambda: 2048 * 2)
+
+    assert rag.RagEngine()._llm_instance_budget() == 1
+
+    monkeypatch.setattr(rag, "_available_memory", lambda: 2048 * 10)
+    assert rag.RagEngine()._llm_instance_budget() == 4
+
+
+def test_available_memory_respects_the_container_limit(tmp_path, monkeypatch):
+    limit, usage = tmp_path / "memory.max", tmp_path / "memory.current"
+    limit.write_text("4294967296\n")
+    usage.write_text(str(1024**3))
+    monkeypatch.setattr(rag, "CGROUP_MEMORY_FILES", ((str(tmp_path / "missing"), str(usage)), (str(limit), str(usage))))
+    monkeypatch.setattr(rag, "_host_available_memory", lambda: 64 * 1024**3)
+
+    assert rag._available_memory() == 3 * 1024**3
+
+    limit.write_text("max\n")
+    assert rag._available_memory() == 64 * 1024**3
+    monkeypatch.setattr(rag, "_host_available_memory", lambda: None)
+    assert rag._available_memory() is None
+
+
+def test_concurrent_questions_share_embedding_and_vector_search():
+    engine = rag.RagEngine()
+    engine.retrieval_batcher = rag.MicroBatcher(engine._lookup_batch, 8, 0.2, name="test-retrieval")
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_documents.side_effect = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    engine.vector_store = MagicMock()
+    engine.vector_store._collection.query.side_effect = lambda query_embeddings, n_results, include: {
+        "documents": [[f"doc for {vector[0]:.0f}-{i}" for i in range(n_results)] for vector in query_embeddings],
+        "metadatas": [[{"page": i} for i in range(n_results)] for _ in query_embeddings],
+    }
+
+    questions = {"a?": 1, "bbb?": 3, "cc?": None}
+    results = {}
+    start = threading.Barrier(len(questions))
+
+    def lookup(question, k):
+        start.wait()
+        results[question] = engine._lookup(question, k, engine._cache_scope(k, None, None))
+
+    threads = [threading.Thread(target=lookup, args=item) for item in questions.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert engine._embeddings_tool.embed_documents.call_count == 1
+    assert engine.vector_store._collection.query.call_count == 1
+    assert engine.vector_store._collection.query.call_args.kwargs["n_results"] == 3
+    for question, k in questions.items():
+        embedding, cached, docs = results[question]
+        assert embedding == [float(len(question)), 1.0]
+        assert cached is None
+        assert [doc.page_content for doc in docs] == [f"doc for {len(question)}-{i}" for i in range(k or rag.RETRIEVAL_K)]
+
+
+def word_tokenizer_engine():
+    engine = rag.RagEngine()
+    engine.llm = MagicMock()
+    engine.llm.client.tokenize.side_effect = lambda text: text.split()
+    return engine
+
+
+def test_context_packer_drops_duplicates_and_trims_to_budget(monkeypatch):
+    monkeypatch.setattr(rag, "CONTEXT_TOKEN_BUDGET", 40)
+    monkeypatch.setattr(rag, "MIN_TRIMMED_TOKENS", 5)
+    engine = word_tokenizer_engine()
+    best = rag.Document(page_content=" ".join(f"best{i}" for i in range(20)), metadata={"page": 1})
+    repeat = rag.Document(page_content=" ".join(f"best{i}" for i in range(5, 15)), metadata={"page": 2})
+    long = rag.Document(page_content=" ".join(f"long{i}" for i in range(50)), metadata={"page": 3})
+    unused = rag.Document(page_content="never reached", metadata={"page": 4})
+
+    prompt, packed = engine._build_prompt([best, repeat, long, unused], "torque?", max_new_tokens=64)
+
+    assert [doc.metadata["page"] for doc in packed] == [1, 3]
+    assert packed[0] is best
+    assert packed[1].page_content == " ".join(f"long{i}" for i in range(20))
+    assert sum(len(doc.page_content.split()) for doc in packed) <= 40
+    assert "never reached" not in prompt
+
+
+def test_context_packer_respects_the_model_window(monkeypatch):
+    monkeypatch.setattr(rag, "CONTEXT_LENGTH", 100)
+    engine = word_tokenizer_engine()
+    doc = rag.Document(page_content=" ".join(f"word{i}" for i in range(200)), metadata={})
+
+    prompt, _ = engine._build_prompt([doc], "torque?", max_new_tokens=40)
+    assert len(prompt.split()) + 40 <= 100
+
+    with pytest.raises(ValueError):
+        engine._build_prompt([doc], " ".join(["why"] * 200), max_new_tokens=40)
+
+
+def test_hybrid_retrieval_merges_keyword_hits_by_rank(tmp_path):
+    engine = rag.RagEngine()
+    engine.lexical_index = rag.LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine.vector_store = MagicMock()
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_query.return_value = [1.0, 0.0]
+
+    chunks = [
+        rag.Document(page_content="General valve maintenance guidance.", metadata={"page": 1}),
+        rag.Document(page_content="Valve PN-1234 needs a 42 Nm torque.", metadata={"page": 2}),
+        rag.Document(page_content="Sensor wiring overview.", metadata={"page": 3}),
+    ]
+    engine.add_documents(chunks)
+    assert engine.lexical_index.size() == 3
+
+    # the embedding search misses the part number entirely
+    engine.vector_store.similarity_search_by_vector.return_value = [chunks[0], chunks[2]]
+    _, _, docs = engine._lookup_batch([("torque for PN-1234?", 2, None, engine._cache_scope(2, None, None))])[0]
+
+    assert [doc.metadata["page"] for doc in docs] == [1, 2]
+
+
+def test_fusion_keeps_a_shared_passage_once_per_document(tmp_path):
+    engine = rag.RagEngine()
+    engine.lexical_index = rag.LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine.vector_store = MagicMock()
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_query.return_value = [1.0, 0.0]
+
+    text = "Valve PN-1234 needs a 42 Nm torque."
+    chunks = [rag.Document(page_content=text, metadata={"doc_id": doc_id}) for doc_id in ("pump", "skid")]
+    engine.add_documents(chunks)
+    engine.vector_store.similarity_search_by_vector.return_value = chunks
+
+    _, _, docs = engine._lookup_batch([("torque for PN-1234?", 4, None, engine._cache_scope(4, None, None))])[0]
+
+    assert sorted(doc.metadata["doc_id"] for doc in docs) == ["pump", "skid"]
+
+
+def test_keyword_index_is_backfilled_from_an_existing_store(tmp_path):
+    engine = rag.RagEngine()
+    engine.lexical_index = rag.LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine.vector_store = MagicMock()
+    engine.vector_store.get.side_effect = [
+        {"ids": ["a" * 64, "b" * 64], "documents": ["valve PN-1234", "sensor E-42"], "metadatas": [{"page": 1}, None]},
+    ]
+
+    engine._backfill_lexical_index()
+
+    assert engine.lexical_index.size() == 2
+    assert engine.lexical_index.search("E-42", k=1)[0][1] == "sensor E-42"
+
+
+def test_document_filter_builds_chroma_where_clause():
+    assert rag.document_filter() is None
+    assert rag.document_filter(["a"]) == {"doc_id": "a"}
+    assert rag.document_filter(["a", "b", "a"], [" Manuals ", "manuals"]) == {
+        "$and": [{"doc_id": {"$in": ["a", "b"]}}, {"tag_manuals": True}]
+    }
+    assert rag.document_filter(tags=["x", "y"]) == {"$or": [{"tag_x": True}, {"tag_y": True}]}
+    assert rag.tag_metadata(["Pumps", "valves"]) == {"tags": "pumps,valves", "tag_pumps": True, "tag_valves": True}
+
+
+def test_filtered_questions_are_searched_per_filter(tmp_path):
+    engine = rag.RagEngine()
+    engine.lexical_index = rag.LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine._embeddings_tool = MagicMock()
+    engine._embeddings_tool.embed_documents.side_effect = lambda texts: [[1.0, 0.0] for _ in texts]
+    engine.vector_store = MagicMock()
+    engine.vector_store._collection.query.return_value = {"documents": [[], []], "metadatas": [[], []]}
+    engine.vector_store.similarity_search_by_vector.return_value = []
+
+    chunks = [
+        rag.Document(page_content="Valve PN-1234 torque is 42 Nm.", metadata={"doc_id": "pump", "page": 1}),
+        rag.Document(page_content="Valve PN-1234 torque is 42 Nm.", metadata={"doc_id": "boiler", "page": 7}),
+    ]
+    engine.add_documents(chunks)
+    # identical text in two documents stays two chunks
+    assert engine.lexical_index.size() == 2
+
+    where = rag.document_filter(["boiler"])
+    requests = [
+        ("PN-1234?", 3, where, engine._cache_scope(3, None, None, where)),
+        ("PN-1234 torque?", 3, where, engine._cache_scope(3, None, None, where)),
+        ("anything else?", 3, None, engine._cache_scope(3, None, None)),
+    ]
+    results = engine._lookup_batch(requests)
+
+    query = engine.vector_store._collection.query.call_args.kwargs
+    assert query["where"] == {"doc_id": "boiler"}
+    assert len(query["query_embeddings"]) == 2
+    assert "filter" not in engine.vector_store.similarity_search_by_vector.call_args.kwargs
+    assert [doc.metadata for doc in results[0][2]] == [{"doc_id": "boiler", "page": 7}]
+    assert engine._cache_scope(3, None, None, where) != engine._cache_scope(3, None, None)
+
+
+def test_deletes_past_the_threshold_compact_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag, "COMPACTION_MIN_DELETES", 2)
+    monkeypatch.setattr(rag, "MEMORY_PATH", str(tmp_path))
+    engine = rag.RagEngine()
+    engine.lexical_index = rag.LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    engine.vector_store = MagicMock()
+    chunks = [rag.Document(page_content=f"chunk {i}", metadata={"doc_id": "d1"}) for i in range(3)]
+    engine.add_documents(chunks)
+    ids = [engine.chunk_id(chunk.page_content, "d1") for chunk in chunks]
+
+    engine.vector_store.get.return_value = {"ids": ids[:1]}
+    engine.delete_document("d1")
+    assert engine.compaction_status()["compactions"] == 0
+
+    engine.vector_store.get.return_value = {"ids": ids[1:]}
+    assert engine.delete_document("d1") == 2
+    engine._compaction.join(5)
+
+    status = engine.compaction_status()
+    assert status["compactions"] == 1
+    assert status["deleted_since_compaction"] == 0
+    assert status["last"]["deleted_chunks"] == 3
+    assert status["last"]["errors"] == []
+    assert engine.lexical_index.size() == 0
+
+
+def test_llama_cpp_backend_names_the_package_it_needs(monkeypatch):
+    # None in sys.modules makes the import fail as if it were not installed
+    monkeypatch.setitem(sys.modules, "llama_cpp", None)
+    with pytest.raises(RuntimeError, match="pip install llama-cpp-python"):
+        rag.LlamaCppBackend().load({})
+
+    with pytest.raises(TypeError):
+        rag.LLMBackend()
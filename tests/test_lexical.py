@@ -0,0 +1,96 @@
+import hashlib
+import os
+
+from app.lexical import LexicalIndex
+
+
+def chunk_id(n):
+    return hashlib.sha256(str(n).encode()).hexdigest()
+
+
+def test_exact_codes_rank_first_and_reopen(tmp_path):
+    path = str(tmp_path / "lexical.sqlite3")
+    index = LexicalIndex(path)
+    index.add(
+        [chunk_id(1), chunk_id(2), chunk_id(3)],
+        [
+            "Error E-42 means the pressure sensor on valve PN-1234 is disconnected.",
+            "Replace the pressure sensor every 2000 hours.",
+            "Torque the PN-9999 bracket to 42 Nm.",
+        ],
+        [{"page": 1}, {"page": 2}, {"page": 3}],
+    )
+    index.close()
+
+    reopened = LexicalIndex(path)
+    results = reopened.search("what does error E-42 mean?", k=3)
+    assert [result[0] for result in results] == [chunk_id(1)]
+    assert results[0][2] == {"page": 1}
+
+    results = reopened.search("PN-9999 torque", k=3)
+    assert results[0][0] == chunk_id(3)
+    assert reopened.search("nothing relevant here", k=3) == []
+
+
+def test_readding_a_chunk_replaces_it(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    index.add([chunk_id(1)], ["valve PN-1234"], [{"page": 1}])
+    index.add([chunk_id(1), chunk_id(2)], ["valve PN-1234", "valve PN-5678"], [{"page": 9}, {"page": 2}])
+
+    assert index.size() == 2
+    assert [result[2] for result in index.search("PN-1234", k=5)] == [{"page": 9}]
+
+
+def test_very_common_terms_are_left_out_of_the_query(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    count = 200
+    index.add(
+        [chunk_id(n) for n in range(count)],
+        [f"pressure reading {n}" + (" calibration" if n == 7 else "") for n in range(count)],
+        [{} for _ in range(count)],
+    )
+
+    # "pressure" is in every chunk, so only "calibration" decides the match
+    assert [result[0] for result in index.search("pressure calibration", k=5)] == [chunk_id(7)]
+    assert index.search("pressure", k=5) == []
+
+
+def test_search_before_indexing_creates_nothing(tmp_path):
+    path = tmp_path / "nested" / "lexical.sqlite3"
+    index = LexicalIndex(str(path))
+
+    assert index.search("PN-1234", k=3) == []
+    assert index.size() == 0
+    assert not os.path.exists(path.parent)
+
+
+def test_search_applies_metadata_filter(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    index.add(
+        [chunk_id(1), chunk_id(2), chunk_id(3)],
+        ["valve PN-1234 torque", "valve PN-1234 wiring", "valve PN-1234 seal"],
+        [{"doc_id": "a", "tag_pumps": True}, {"doc_id": "b"}, {"doc_id": "c", "tag_valves": True}],
+    )
+
+    def docs(where):
+        return sorted(result[2]["doc_id"] for result in index.search("PN-1234", k=5, where=where))
+
+    assert docs({"doc_id": "b"}) == ["b"]
+    assert docs({"doc_id": {"$in": ["a", "c"]}}) == ["a", "c"]
+    assert docs({"$or": [{"tag_pumps": True}, {"tag_valves": True}]}) == ["a", "c"]
+    assert docs({"$and": [{"doc_id": {"$in": ["a", "b"]}}, {"tag_pumps": True}]}) == ["a"]
+
+
+def test_delete_removes_chunks_and_term_counts(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.sqlite3"))
+    index.add([chunk_id(1), chunk_id(2)], ["valve PN-1234 seal", "valve PN-5678 seal"], [{"page": 1}, {"page": 2}])
+
+    assert index.delete([chunk_id(1), chunk_id(3)]) == 1
+    assert index.size() == 1
+    assert index.search("PN-1234", k=5) == []
+    assert [result[0] for result in index.search("PN-5678", k=5)] == [chunk_id(2)]
+
+    index.compact()
+    assert index.delete([chunk_id(2)]) == 1
+    assert index.size() == 0
+    assert index._connect(create=False).execute("SELECT COUNT(*) FROM terms").fetchone()[0] == 0
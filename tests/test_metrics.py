@@ -0,0 +1,31 @@
+from app import metrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("test_seconds", "Test timings.", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, stage="embed")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test timings.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="embed",le="0.1"} 2',
+        'test_seconds_bucket{stage="embed",le="1"} 3',
+        'test_seconds_bucket{stage="embed",le="+Inf"} 4',
+        'test_seconds_count{stage="embed"} 4',
+        'test_seconds_sum{stage="embed"} 3.65',
+    ]
+
+
+def test_counter_and_collector_output(monkeypatch):
+    counter = metrics.Counter("test_total", "Things.", ("kind",))
+    counter.inc(kind='a "quoted"\nvalue')
+    counter.inc(2, kind='a "quoted"\nvalue')
+    assert counter.render()[-1] == 'test_total{kind="a \\"quoted\\"\\nvalue"} 3'
+
+    # collectors are process wide; these must not show up in later scrapes
+    monkeypatch.setattr(metrics, "_collectors", [])
+    metrics.register_collector(lambda: [("test_depth", "gauge", "Depth.", [({}, 4)])])
+    metrics.register_collector(lambda: 1 / 0)
+    output = metrics.render()
+    assert "# TYPE test_depth gauge\ntest_depth 4\n" in output
@@ -0,0 +1,154 @@
+import importlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock
+
+import pytest
+
+
+@pytest.fixture
+def pdf():
+    # other test modules purge app.* from sys.modules, and the process pool
+    # can only pickle functions of the module currently registered there
+    return importlib.import_module("app.pdf")
+
+
+def write_text_pdf(path, page_texts):
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        page_refs.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % ref for ref in page_refs)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_refs))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+    with open(path, "wb") as f:
+        f.write(bytes(out))
+    return str(path)
+
+
+def test_page_ranges_cover_every_page_once(pdf):
+    assert pdf.page_ranges(10, workers=4, min_pages=1) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert pdf.page_ranges(10, workers=4, min_pages=25) == [(0, 10)]
+    assert pdf.page_ranges(0, workers=4, min_pages=1) == []
+    # a long document is cut into more ranges than there are workers
+    ranges = pdf.page_ranges(2000, workers=8, min_pages=25, max_pages=50)
+    assert len(ranges) == 40 and ranges[-1] == (1950, 2000)
+
+
+def test_extract_pages_in_process(pdf, tmp_path):
+    path = write_text_pdf(tmp_path / "small.pdf", ["alpha", "beta", "gamma"])
+    progress = MagicMock()
+
+    pages = list(pdf.extract_pages(path, workers=1, on_pages=progress))
+
+    assert [(number, text.strip()) for number, text in pages] == [(0, "alpha"), (1, "beta"), (2, "gamma")]
+    progress.assert_called_once_with(3)
+
+
+def test_extract_pages_across_process_pool_keeps_order(pdf, tmp_path, monkeypatch):
+    texts = [f"page{i}" for i in range(6)]
+    path = write_text_pdf(tmp_path / "large.pdf", texts)
+    monkeypatch.setattr(pdf, "MIN_PAGES_PER_WORKER", 1)
+    progress = MagicMock()
+
+    try:
+        pages = list(pdf.extract_pages(path, workers=3, on_pages=progress))
+    finally:
+        pdf.shutdown_pool()
+
+    assert [text.strip() for _, text in pages] == texts
+    assert [number for number, _ in pages] == list(range(6))
+    assert sum(call.args[0] for call in progress.call_args_list) == 6
+
+
+def test_failing_page_falls_back_without_affecting_others(pdf):
+    page = MagicMock()
+    page.extract_text.side_effect = [Exception("bad content stream"), "layout text"]
+
+    assert pdf._extract_page_text(page) == "layout text"
+    assert page.extract_text.call_args.kwargs == {"extraction_mode": "layout"}
+
+    broken = MagicMock()
+    broken.extract_text.side_effect = Exception("unreadable")
+    assert pdf._extract_page_text(broken) == ""
+
+
+def test_broken_pool_is_replaced_and_the_document_resumed(pdf, tmp_path, monkeypatch):
+    texts = [f"page{i}" for i in range(6)]
+    path = write_text_pdf(tmp_path / "large.pdf", texts)
+    monkeypatch.setattr(pdf, "MIN_PAGES_PER_WORKER", 1)
+    pools = []
+
+    class FakePool(ThreadPoolExecutor):
+        # the first pool loses a worker on the second range, as if it were killed
+        def __init__(self, max_workers, mp_context=None):
+            super().__init__(max_workers=max_workers)
+            self.broken = not pools
+            pools.append(self)
+
+        def submit(self, fn, file_path, start, stop):
+            if self.broken and start > 0:
+                future = Future()
+                future.set_exception(BrokenProcessPool("a worker died"))
+                return future
+            return super().submit(fn, file_path, start, stop)
+
+    monkeypatch.setattr(pdf, "ProcessPoolExecutor", FakePool)
+    try:
+        pages = list(pdf.extract_pages(path, workers=3))
+        assert pdf._pool is pools[1]
+        # later documents get the healthy pool
+        assert [text.strip() for _, text in pdf.extract_pages(path, workers=3)] == texts
+    finally:
+        pdf.shutdown_pool()
+
+    assert [text.strip() for _, text in pages] == texts
+    assert [number for number, _ in pages] == list(range(6))
+    assert len(pools) == 2
+
+
+def test_long_documents_keep_a_bounded_window_of_ranges_in_flight(pdf, tmp_path, monkeypatch):
+    texts = [f"page{i}" for i in range(12)]
+    path = write_text_pdf(tmp_path / "long.pdf", texts)
+    monkeypatch.setattr(pdf, "MIN_PAGES_PER_WORKER", 1)
+    monkeypatch.setattr(pdf, "MAX_PAGES_PER_RANGE", 1)
+    submitted = []
+
+    class CountingPool(ThreadPoolExecutor):
+        def __init__(self, max_workers, mp_context=None):
+            super().__init__(max_workers=max_workers)
+
+        def submit(self, fn, *args):
+            submitted.append(args)
+            return super().submit(fn, *args)
+
+    monkeypatch.setattr(pdf, "ProcessPoolExecutor", CountingPool)
+    try:
+        pages = pdf.extract_pages(path, workers=2)
+        assert next(pages)[1].strip() == "page0"
+        # twice the workers in flight, plus the one submitted as the first came back
+        assert len(submitted) == 5
+        assert [text.strip() for _, text in pages] == texts[1:]
+    finally:
+        pdf.shutdown_pool()
+    assert len(submitted) == 12
@@ -0,0 +1,99 @@
+import re
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+for module_name in list(sys.modules.keys()):
+    if module_name.startswith("app.") or module_name == "app":
+        del sys.modules[module_name]
+
+sys.modules["langchain_text_splitters"] = MagicMock()
+sys.modules["langchain_community.embeddings"] = MagicMock()
+sys.modules["langchain_community.llms"] = MagicMock()
+sys.modules["langchain_chroma"] = MagicMock()
+
+from app import rag
+
+EVAL_SECONDS_PER_TOKEN = 0.0002
+
+
+class FakeModel:
+    """Token-level stand-in for a ctransformers model: evaluation costs time per token
+    and, like ctransformers >= 0.2.27, only the part of a prompt that differs from the
+    evaluated context is run again unless reuse is switched off."""
+
+    def __init__(self, reuse_prefix=True):
+        self.reuse_prefix = reuse_prefix
+        self._context = []
+        self.evaluated = 0
+
+    def tokenize(self, text):
+        return re.findall(r"\w+|[^\w\s]|\s", text)
+
+    def prepare_inputs_for_generation(self, tokens):
+        if not self.reuse_prefix:
+            self._context = []
+            return tokens
+        n = min(len(tokens) - 1, len(self._context))
+        shared = 0
+        while shared < n and tokens[shared] == self._context[shared]:
+            shared += 1
+        self._context = self._context[:shared]
+        return tokens[shared:]
+
+    def eval(self, tokens):
+        time.sleep(EVAL_SECONDS_PER_TOKEN * len(tokens))
+        self.evaluated += len(tokens)
+        self._context.extend(tokens)
+
+    def __call__(self, prompt, stream=True, **params):
+        self.eval(self.prepare_inputs_for_generation(self.tokenize(prompt)))
+        for token in ["the", " answer"]:
+            self.eval([token])
+            yield token
+
+
+def run_queries(model, prefix_cache, questions):
+    engine = rag.RagEngine()
+    wrapper = MagicMock()
+    wrapper.client = model
+    with patch.object(sys.modules["langchain_community.llms"], "CTransformers", return_value=wrapper), patch.object(rag, "PREFIX_CACHE", prefix_cache):
+        llm = engine._new_llm(engine._backend_settings(1))
+    engine.llm = llm
+
+    prompt_evals = []
+    started = time.perf_counter()
+    for number, question in enumerate(questions):
+        docs = [rag.Document(page_content=f"chunk {number} says the torque for part {number} is {number * 7} Nm", metadata={})]
+        prompt, _ = engine._build_prompt(docs, question)
+        before = model.evaluated
+        answer = "".join(engine._generate(llm, prompt, time.monotonic() + 60))
+        assert answer == "the answer"
+        prompt_evals.append(model.evaluated - before - 2)
+    return prompt_evals, (time.perf_counter() - started) / len(questions)
+
+
+def test_benchmark_prefix_reuse_saves_prompt_eval():
+    questions = [f"what is the torque for part {n}?" for n in range(10)]
+    prefix_tokens = len(FakeModel().tokenize(rag.PROMPT_PREFIX))
+
+    baseline, baseline_seconds = run_queries(FakeModel(reuse_prefix=False), False, questions)
+    primed, primed_seconds = run_queries(FakeModel(reuse_prefix=True), True, questions)
+
+    saved = [full - reused for full, reused in zip(baseline, primed)]
+    print(
+        f"\nprompt tokens evaluated per query: {sum(baseline) / len(baseline):.0f} -> {sum(primed) / len(primed):.0f}"
+        f" ({prefix_tokens} prefix tokens), {baseline_seconds * 1000:.1f} ms -> {primed_seconds * 1000:.1f} ms per query"
+    )
+    # every query, the first one included, skips at least the whole static preamble
+    assert saved[0] == prefix_tokens
+    assert all(tokens >= prefix_tokens for tokens in saved)
+    assert primed_seconds < baseline_seconds
+
+
+def test_priming_failure_does_not_block_loading(capsys):
+    wrapper = MagicMock()
+    wrapper.client.tokenize.side_effect = RuntimeError("no tokenizer")
+    with patch.object(sys.modules["langchain_community.llms"], "CTransformers", return_value=wrapper):
+        assert rag.RagEngine()._new_llm(rag.RagEngine()._backend_settings(1)) is wrapper
+    assert "could not prime the prompt prefix: no tokenizer" in capsys.readouterr().out
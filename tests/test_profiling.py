@@ -0,0 +1,35 @@
+import threading
+import time
+
+from app import profiling
+
+
+def spin_until(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampler_folds_stacks_of_busy_threads():
+    profiler = profiling.SamplingProfiler()
+    stop = threading.Event()
+    worker = threading.Thread(target=spin_until, args=(stop,), name="busy-worker_3")
+    worker.start()
+    try:
+        assert profiler.start(interval_ms=1)
+        assert not profiler.start(interval_ms=1)
+        time.sleep(0.2)
+        samples = profiler.stop()
+    finally:
+        stop.set()
+        worker.join()
+
+    assert profiler.ticks > 0
+    busy = [stack for stack in samples if "spin_until" in stack]
+    assert busy
+    assert all(stack.startswith("thread busy-worker;") for stack in busy)
+    # the profiler never samples itself
+    assert not any("_run (app/profiling.py" in stack for stack in samples)
+
+    output = profiling.collapse(samples)
+    first = output.splitlines()[0]
+    assert int(first.rsplit(" ", 1)[1]) == max(samples.values())
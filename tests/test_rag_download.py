@@ -1,7 +1,12 @@
+import hashlib
 import os
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock, patch
 
+import pytest
+
 # --- step 0: ensure app modules are not already loaded ---
 for module_name in list(sys.modules.keys()):
     if module_name.startswith("app.") or module_name == "app":
@@ -22,94 +27,190 @@ sys.modules["ctransformers"] = MagicMock()
 sys.modules["sentence-transformers"] = MagicMock()
 
 # now import the module to test
-from app.rag import rag_engine, MODEL_PATH
-
-def test_download_model_success():
-    # we patch requests.get because app.rag uses requests.get directly
-    with patch("requests.get") as mock_get, \
-         patch("builtins.open", new_callable=MagicMock) as mock_open, \
-         patch("os.path.exists") as mock_exists, \
-         patch("os.makedirs") as mock_makedirs, \
-         patch("os.rename") as mock_rename, \
-         patch("os.remove") as mock_remove:
-
-        # scenario: model does not exist
-        def exists_side_effect(path):
-            if path == MODEL_PATH:
-                return False
-            return True # models dir exists
-
-        mock_exists.side_effect = exists_side_effect
-
-        # mock response
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.iter_content.return_value = [b"chunk1", b"chunk2"]
-        mock_get.return_value = mock_response
-
-        # mock file writing
-        mock_file = MagicMock()
-        mock_open.return_value.__enter__.return_value = mock_file
-
+from app import download, rag
+from app.rag import rag_engine
+
+PAYLOAD = bytes(range(256)) * 1024
+
+
+class ModelHandler(BaseHTTPRequestHandler):
+    accept_ranges = True
+    drop_after = None
+    ignore_range_end = False
+    ranges_seen = []
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        requested = self.headers.get("Range")
+        type(self).ranges_seen.append(requested)
+        if requested and self.accept_ranges:
+            first, _, last = requested.split("=")[1].partition("-")
+            start, end = int(first), int(last) if last else len(PAYLOAD) - 1
+            if type(self).ignore_range_end and end < len(PAYLOAD) - 1:
+                end, type(self).ignore_range_end = len(PAYLOAD) - 1, False
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            start, end = 0, len(PAYLOAD) - 1
+            self.send_response(200)
+        body = PAYLOAD[start : end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if type(self).drop_after is not None:
+            # simulate a flaky link: send part of the body once, then cut the connection
+            body, type(self).drop_after = body[: self.drop_after], None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ModelHandler.accept_ranges = True
+    ModelHandler.drop_after = None
+    ModelHandler.ignore_range_end = False
+    ModelHandler.ranges_seen = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ModelHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/model.gguf"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay():
+    with patch.object(download, "RETRY_DELAY", 0), patch.object(download, "READ_SIZE", 1000):
+        yield
+
+
+def test_download_model_success(server, tmp_path):
+    model_path = str(tmp_path / "models" / "model.gguf")
+    with patch.object(rag, "MODEL_URL", server), \
+         patch.object(rag, "MODEL_PATH", model_path), \
+         patch.object(rag, "MODEL_SHA256", hashlib.sha256(PAYLOAD).hexdigest()), \
+         patch.object(rag, "MIN_MODEL_BYTES", 1):
         rag_engine._download_model_if_needed()
 
-        # check if downloaded
-        mock_get.assert_called()
-
-        # check if wrote to temp file
-        temp_path = MODEL_PATH + ".part"
-        mock_open.assert_called_with(temp_path, "wb")
-
-        mock_file.write.assert_any_call(b"chunk1")
-        mock_file.write.assert_any_call(b"chunk2")
-
-        # check if renamed
-        mock_rename.assert_called_with(temp_path, MODEL_PATH)
-
-def test_download_model_failure_cleanup():
-    """
-    test that if download fails, the temporary file is removed.
-    """
-    with patch("requests.get") as mock_get, \
-         patch("builtins.open", new_callable=MagicMock) as mock_open, \
-         patch("os.path.exists") as mock_exists, \
-         patch("os.makedirs"), \
-         patch("os.rename") as mock_rename, \
-         patch("os.remove") as mock_remove:
-
-        # model does not exist
-        def exists_side_effect(path):
-            if path == MODEL_PATH:
-                return False
-            # during cleanup, it checks if temp path exists
-            if path == MODEL_PATH + ".part":
-                return True
-            return True
-
-        mock_exists.side_effect = exists_side_effect
-
-        # mock response that fails during iteration
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-
-        def iter_fail(*args, **kwargs):
-            yield b"chunk1"
-            raise ConnectionError("connection lost")
-
-        mock_response.iter_content.side_effect = iter_fail
-        mock_get.return_value = mock_response
-
-        mock_file = MagicMock()
-        mock_open.return_value.__enter__.return_value = mock_file
-
-        try:
-            rag_engine._download_model_if_needed()
-        except ConnectionError:
-            pass
-
-        # verify if cleanup happened
-        temp_path = MODEL_PATH + ".part"
-        mock_remove.assert_called_with(temp_path)
-
-        # verify rename was not called
-        mock_rename.assert_not_called()
+    with open(model_path, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert not os.path.exists(model_path + ".part")
+
+
+def test_download_resumes_from_partial_file(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    with open(dest + ".part", "wb") as f:
+        f.write(PAYLOAD[:1000])
+
+    download.download_file(server, dest)
+
+    assert ModelHandler.ranges_seen == ["bytes=1000-"]
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_dropped_connection_resumes_instead_of_restarting(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    ModelHandler.drop_after = 5000
+
+    download.download_file(server, dest)
+
+    assert ModelHandler.ranges_seen[0] is None
+    assert ModelHandler.ranges_seen[1] == "bytes=5000-"
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_download_failure_keeps_partial_for_next_start(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    ModelHandler.drop_after = 5000
+
+    with patch.object(download, "DOWNLOAD_RETRIES", 1), pytest.raises(Exception):
+        download.download_file(server, dest)
+
+    assert os.path.getsize(dest + ".part") == 5000
+    assert not os.path.exists(dest)
+
+
+def test_segmented_download_fetches_ranges_in_parallel(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+
+    download.download_file(server, dest, segments=4, min_segment_bytes=1024)
+
+    assert len(ModelHandler.ranges_seen) == 4
+    assert all(seen.startswith("bytes=") for seen in ModelHandler.ranges_seen)
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert os.listdir(tmp_path) == ["model.gguf"]
+
+
+def test_server_without_range_support_restarts_cleanly(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    ModelHandler.accept_ranges = False
+    with open(dest + ".part", "wb") as f:
+        f.write(b"stale bytes from another file")
+
+    download.download_file(server, dest, segments=4, min_segment_bytes=1024)
+
+    assert ModelHandler.ranges_seen == [None]
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_checksum_mismatch_discards_download(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+
+    with pytest.raises(download.ChecksumError):
+        download.download_file(server, dest, expected_sha256="0" * 64)
+
+    assert not os.path.exists(dest)
+    assert not os.path.exists(dest + ".part")
+
+
+def test_oversized_segment_is_fetched_again_before_merging(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    # one response runs to the end of the file instead of the end of its range
+    ModelHandler.ignore_range_end = True
+
+    download.download_file(server, dest, segments=4, min_segment_bytes=1024)
+
+    assert len(ModelHandler.ranges_seen) == 5
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert os.listdir(tmp_path) == ["model.gguf"]
+
+
+def test_partial_larger_than_the_file_is_discarded(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    with open(dest + ".part", "wb") as f:
+        f.write(PAYLOAD + b"trailing bytes")
+
+    download.download_file(server, dest)
+
+    assert ModelHandler.ranges_seen == [None]
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_resume_after_an_interrupted_merge_removes_leftover_segments(server, tmp_path):
+    dest = str(tmp_path / "model.gguf")
+    with open(dest + ".part", "wb") as f:
+        f.write(PAYLOAD[:1000])
+    with open(dest + ".part.0-999", "wb") as f:
+        f.write(PAYLOAD[:1000])
+
+    download.download_file(server, dest, segments=4, min_segment_bytes=1024)
+
+    assert ModelHandler.ranges_seen == ["bytes=1000-"]
+    with open(dest, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert os.listdir(tmp_path) == ["model.gguf"]